@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""Admission control in front of the expensive part of handling a message
+
+Two limits are applied before a message is detected and parsed:
+    per user: a token bucket (user_rate messages a second, with bursts of up
+        to user_burst), so one chatty user or a retry storm cannot take over
+    overall: at most max_in_flight messages are detected / parsed at once, with
+        up to max_queue more waiting for a turn
+
+A message that would have to wait longer than max_delay for either is
+rejected straight away, so the bot can give a cheap canned reply instead and
+latency stays bounded for everyone else.
+
+admit blocks the calling thread while a message waits; admit_async is the same
+for an asyncio event loop.  Its two steps can also be taken separately
+(take_token_async, then acquire_slot_async), as the HTTP channel does: the
+user's token is taken when a message arrives, but a place is only taken once
+the message is next in line for its user, so messages queued behind their own
+user's earlier ones do not hold places that other users are waiting for."""
+
+import time
+import threading
+from collections import deque
+
+ADMITTED = 'admitted'
+DELAYED = 'delayed'
+REJECTED_RATE = 'rejected_rate'
+REJECTED_OVERLOAD = 'rejected_overload'
+# beyond this many users, buckets that have filled up again are dropped
+MAX_BUCKETS = 10000
+
+
+class TokenBucket(object):
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+
+
+class AdmissionControl(object):
+    """Decides whether each message goes ahead, waits briefly or is turned away
+
+    user_rate: messages a second allowed per user (0 = no per user limit)
+    user_burst: messages a user can send at once before the rate applies
+    max_in_flight: messages processed at once (0 = no limit)
+    max_queue: messages allowed to wait for one of those places
+    max_delay: longest a message may wait (in seconds) before it is rejected"""
+
+    def __init__(self, user_rate=0.0, user_burst=5, max_in_flight=0, max_queue=0, max_delay=0.5):
+        self.user_rate = user_rate
+        self.user_burst = max(user_burst, 1)
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_delay = max_delay
+        self.buckets = {}   # user_id -> TokenBucket
+        self.in_flight = 0
+        self.waiting = 0
+        self.counts = {ADMITTED: 0, DELAYED: 0, REJECTED_RATE: 0, REJECTED_OVERLOAD: 0}
+        self._lock = threading.Lock()
+        self._slot_free = threading.Condition(self._lock)
+        self._async_waiters = deque()   # futures of admit_async calls waiting for a place
+
+    def _take_token(self, user_id, now):
+        """Takes a token from the user's bucket
+
+        Return: seconds to wait before going ahead (None if that is too long,
+        in which case no token is taken)"""
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            if len(self.buckets) >= MAX_BUCKETS:
+                self._prune(now)
+            bucket = self.buckets[user_id] = TokenBucket(float(self.user_burst), now)
+        bucket.tokens = min(float(self.user_burst), bucket.tokens + (now - bucket.updated) * self.user_rate)
+        bucket.updated = now
+        wait = 0.0 if bucket.tokens >= 1.0 else (1.0 - bucket.tokens) / self.user_rate
+        if wait > self.max_delay:
+            return None
+        bucket.tokens -= 1.0
+        return wait
+
+    def _prune(self, now):
+        """Drops the buckets of users who have been quiet long enough for them to be full"""
+        refill = self.user_burst / self.user_rate
+        for user_id in [user_id for user_id, bucket in self.buckets.items() if now - bucket.updated >= refill]:
+            del self.buckets[user_id]
+
+    def admit(self, user_id):
+        """Waits (for up to max_delay) until the message can go ahead
+
+        Return: ADMITTED, DELAYED (went ahead after waiting), REJECTED_RATE (user
+        over their rate) or REJECTED_OVERLOAD (too busy). Unless rejected,
+        release must be called once the message has been processed."""
+        started = time.time()
+        wait = 0.0
+        with self._lock:
+            if self.user_rate > 0:
+                wait = self._take_token(user_id, started)
+                if wait is None:
+                    self.counts[REJECTED_RATE] += 1
+                    return REJECTED_RATE
+        if wait > 0:
+            time.sleep(wait)
+
+        with self._lock:
+            if (self.max_in_flight > 0) and (self.in_flight >= self.max_in_flight):
+                if self.waiting >= self.max_queue:
+                    self.counts[REJECTED_OVERLOAD] += 1
+                    return REJECTED_OVERLOAD
+                self.waiting += 1
+                try:
+                    deadline = started + self.max_delay
+                    while self.in_flight >= self.max_in_flight:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self.counts[REJECTED_OVERLOAD] += 1
+                            return REJECTED_OVERLOAD
+                        self._slot_free.wait(remaining)
+                finally:
+                    self.waiting -= 1
+                wait = time.time() - started
+            self.in_flight += 1
+            decision = DELAYED if wait > 0 else ADMITTED
+            self.counts[decision] += 1
+            return decision
+
+    async def admit_async(self, user_id):
+        """As admit, but waits on the running event loop rather than blocking it"""
+        decision = await self.take_token_async(user_id)
+        if decision == REJECTED_RATE:
+            return decision
+        return await self.acquire_slot_async(decision)
+
+    async def take_token_async(self, user_id):
+        """The per user step of admit_async on its own (eg to be taken as soon as
+        a message arrives, with acquire_slot_async left until it is about to be
+        processed)
+
+        Return: ADMITTED, DELAYED (waited for a token) or REJECTED_RATE. Only a
+        REJECTED_RATE is counted, the others are counted by acquire_slot_async."""
+        import asyncio
+        wait = 0.0
+        with self._lock:
+            if self.user_rate > 0:
+                wait = self._take_token(user_id, time.time())
+                if wait is None:
+                    self.counts[REJECTED_RATE] += 1
+                    return REJECTED_RATE
+        if wait > 0:
+            await asyncio.sleep(wait)
+            return DELAYED
+        return ADMITTED
+
+    async def acquire_slot_async(self, decision=ADMITTED):
+        """The overall step of admit_async on its own: waits (for up to max_delay)
+        for one of the max_in_flight places
+
+        decision: what take_token_async decided for the message
+
+        Return: ADMITTED, DELAYED or REJECTED_OVERLOAD. Unless rejected, release
+        must be called once the message has been processed."""
+        import asyncio
+        started = time.time()
+        with self._lock:
+            if (self.max_in_flight <= 0) or (self.in_flight < self.max_in_flight):
+                self.in_flight += 1
+                self.counts[decision] += 1
+                return decision
+            if self.waiting >= self.max_queue:
+                self.counts[REJECTED_OVERLOAD] += 1
+                return REJECTED_OVERLOAD
+            self.waiting += 1
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                remaining = started + self.max_delay - time.time()
+                waiter = loop.create_future()
+                with self._lock:
+                    if self.in_flight < self.max_in_flight:
+                        self.in_flight += 1
+                        self.counts[DELAYED] += 1
+                        return DELAYED
+                    if remaining <= 0:
+                        self.counts[REJECTED_OVERLOAD] += 1
+                        return REJECTED_OVERLOAD
+                    self._async_waiters.append(waiter)
+                try:
+                    await asyncio.wait_for(waiter, remaining)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    with self._lock:
+                        if waiter in self._async_waiters:
+                            self._async_waiters.remove(waiter)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._slot_free.notify()
+            # wake the longest waiting admit_async (on its own loop, as this may be another thread)
+            while len(self._async_waiters) > 0:
+                waiter = self._async_waiters.popleft()
+                if not waiter.done():
+                    waiter.get_loop().call_soon_threadsafe(_wake, waiter)
+                    break
+
+    def stats(self):
+        """Return: a dictionary of the decisions made so far, with the current load"""
+        with self._lock:
+            stats = dict(self.counts)
+            stats['in_flight'] = self.in_flight
+            stats['waiting'] = self.waiting
+            return stats
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
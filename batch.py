@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""Offline (batch) processing of a file of messages, writing the parse results as JSONL"""
+
+import json
+
+import util as u # some local utility functions
+
+
+def result_record(line_no, text, lang, resp, error=None):
+    """Builds the output record for one message (with an 'error' field if its
+    batch could not be parsed)"""
+    record = {'line': line_no, 'text': text, 'lang': lang,
+        'intent': None, 'confidence': 0.0, 'entities': []}
+    if error is not None:
+        record['error'] = error
+    if resp is not None:
+        if 'intent' in resp:
+            record['intent'] = resp['intent']['name']
+            record['confidence'] = float(resp['intent']['confidence'])
+        record['entities'] = resp.get('entities', [])
+    return record
+
+
+def run_batch(core, in_file, out_file, batch_size=256):
+    """Streams the messages in in_file (one per line) through language detection,
+    groups them by language and parses each group batch_size at a time.
+
+    Records are written to out_file as each batch completes, so they are
+    grouped by language rather than in input order (the 'line' field gives
+    the position in the input).  If a batch cannot be parsed (eg its model
+    fails to load or a worker fails) the error is logged, its messages are
+    written with an 'error' field and the run carries on.
+
+    Return: the number of messages processed and the number that could not be parsed"""
+
+    pending = {lang: [] for lang in core.langs_handled}
+    count = 0
+    errors = 0
+
+    def flush(lang):
+        nonlocal errors
+        group = pending[lang]
+        if len(group) == 0:
+            return
+        error = None
+        try:
+            resps = core.parse_batch(lang, [text for line_no, text in group], batch_size)
+        except Exception as e:
+            core.logger.error('Error parsing a batch of {count} messages in {language} (lang: {lang}): {e}'.format(
+                count=len(group), language=core.langs_handled[lang], lang=lang, e=str(e)))
+            core.metrics.count('parse_error', lang)
+            error = str(e)
+            errors += len(group)
+            resps = [None] * len(group)
+        for (line_no, text), resp in zip(group, resps):
+            out_file.write(json.dumps(result_record(line_no, text, lang, resp, error)) + '\n')
+        pending[lang] = []
+
+    for line_no, line in enumerate(in_file, 1):
+        text = u.clean_input(line)
+        count += 1
+        if len(text) == 0:
+            out_file.write(json.dumps(result_record(line_no, text, None, None)) + '\n')
+            continue
+        langs_det, lang_selected = core.detect_language(text)
+        pending[lang_selected].append((line_no, text))
+        if len(pending[lang_selected]) >= batch_size:
+            flush(lang_selected)
+
+    for lang in pending:
+        flush(lang)
+    out_file.flush()
+    return count, errors
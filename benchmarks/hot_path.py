@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks the message hot path, stage by stage, using the training corpora
+(data/mlb_XX.md) as the workload
+
+Stages timed: u.clean_input, langdetect's detect_langs, Core.detect_language
+(the configured detection engine), Interpreter.parse per language and
+Core.check_input end to end (with output going to a null stream).
+
+Run from anywhere:  python benchmarks/hot_path.py [--stub] [--baseline old.json]
+With --stub the interpreters are replaced by a stub, so no trained models (or
+spaCy) are needed.  With --baseline it exits with status 1 if any stage has
+regressed by more than --threshold compared with the baseline results."""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import datetime
+import platform
+
+import click
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT_DIR)
+import util as u # some local utility functions
+from stub_interpreter import stub_loader, benchmark_config
+
+CORPUS_LANGS = ('en', 'fr', 'de')
+
+
+def time_stage(func, inputs, repeat):
+    """Calls func on each input, repeat times over
+
+    Return: latency_summary of the calls"""
+    samples = []
+    timer = time.perf_counter
+    started = timer()
+    for _ in range(repeat):
+        for item in inputs:
+            t0 = timer()
+            func(item)
+            samples.append(timer() - t0)
+    return u.latency_summary(samples, timer() - started)
+
+
+def regressions(results, baseline, threshold):
+    """Compares results with a baseline
+
+    Return: list of descriptions of stages that are more than threshold (a
+    fraction) slower in median latency or throughput"""
+    found = []
+    for stage, summary in sorted(results['stages'].items()):
+        base = baseline.get('stages', {}).get(stage)
+        if base is None:
+            continue
+        if summary['p50_ms'] > base['p50_ms'] * (1.0 + threshold):
+            found.append('{stage}: p50 {now:.3f} ms vs {base:.3f} ms'.format(stage=stage, now=summary['p50_ms'], base=base['p50_ms']))
+        if summary['throughput'] < base['throughput'] * (1.0 - threshold):
+            found.append('{stage}: throughput {now:.1f}/s vs {base:.1f}/s'.format(stage=stage, now=summary['throughput'], base=base['throughput']))
+    return found
+
+
+def print_results(results):
+    print('{stage:<22}{count:>8}{tput:>14}{p50:>10}{p95:>10}{p99:>10}'.format(
+        stage='stage', count='calls', tput='per second', p50='p50 ms', p95='p95 ms', p99='p99 ms'))
+    for stage, s in results['stages'].items():
+        print('{stage:<22}{count:>8}{tput:>14.1f}{p50:>10.3f}{p95:>10.3f}{p99:>10.3f}'.format(
+            stage=stage, count=s['count'], tput=s['throughput'], p50=s['p50_ms'], p95=s['p95_ms'], p99=s['p99_ms']))
+
+
+@click.command()
+@click.option('--stub', is_flag=True, help='Use a stub in place of the trained interpreters.')
+@click.option('--repeat', default=5, help='Number of passes over the workload. Default is 5.')
+@click.option('--with-cache', is_flag=True, help='Leave the parse cache on (it is off by default so every input is fully processed).')
+@click.option('--with-log', is_flag=True, help='Leave the interaction log on (written to a throwaway file; it is off by default).')
+@click.option('--out', 'out_file', default='bench_results.json', help='JSON file to save the results to. Default is bench_results.json.')
+@click.option('--baseline', default='', help='JSON results of an earlier run to compare against.')
+@click.option('--threshold', default=0.2, help='Fraction by which a stage may be slower than the baseline. Default is 0.2.')
+def main(stub, repeat, with_cache, with_log, out_file, baseline, threshold):
+    """Benchmarks each stage of handling a message"""
+    out_file = os.path.abspath(out_file)
+    baseline = os.path.abspath(baseline) if baseline else ''
+    os.chdir(ROOT_DIR)
+
+    corpora = {}
+    for lang in CORPUS_LANGS:
+        data_file = os.path.join('data', 'mlb_{lang}.md'.format(lang=lang))
+        if os.path.exists(data_file):
+            corpora[lang] = [text for intent, text in u.load_training_utterances(data_file)]
+    workload = [text for lang in sorted(corpora) for text in corpora[lang]]
+    cleaned = [u.clean_input(text) for text in workload]
+
+    from mlb import Core
+    from langdetect import detect_langs
+    from langdetect.lang_detect_exception import LangDetectException
+
+    def detect_langs_safely(text):
+        try:
+            return detect_langs(text)
+        except LangDetectException:
+            return []
+
+    config_file = benchmark_config(keep_cache=with_cache, keep_log=with_log)
+    core = Core(channels_out={'screen': True}, loglvl='warn', config_override=config_file,
+        interpreter_loader=stub_loader if stub else None)
+    core.show_language = False
+
+    stages = {}
+    stages['clean_input'] = time_stage(u.clean_input, workload, repeat)
+    stages['detect_langs'] = time_stage(detect_langs_safely, cleaned, repeat)
+    stages['detect_language'] = time_stage(core.detect_language, cleaned, repeat)
+    for lang in sorted(corpora):
+        if lang in core.lang_interpreters:
+            interpreter = core.lang_interpreters[lang]   # loaded here, so not timed
+            stages['parse_' + lang] = time_stage(interpreter.parse, [u.clean_input(text) for text in corpora[lang]], repeat)
+
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as null_out:
+        core.out = null_out
+        sys.stdout = null_out
+        try:
+            stages['check_input'] = time_stage(core.check_input, workload, repeat)
+        finally:
+            core.out = stdout
+            sys.stdout = stdout
+    if core.interaction_log is not None:
+        core.interaction_log.close()
+    shutil.rmtree(os.path.dirname(config_file), ignore_errors=True)
+
+    results = {'stages': stages,
+        'meta': {'time': datetime.datetime.now().isoformat(), 'python': platform.python_version(),
+            'stub': stub, 'repeat': repeat, 'with_cache': with_cache, 'with_log': with_log, 'utterances': len(workload),
+            'detection_engine': core.detection_engine, 'langs_handled': sorted(core.langs_handled)}}
+    print_results(results)
+    with open(out_file, 'w') as results_out:
+        json.dump(results, results_out, indent=2)
+    print('Results saved to ' + out_file)
+
+    if baseline:
+        with open(baseline) as baseline_in:
+            found = regressions(results, json.load(baseline_in), threshold)
+        if len(found) > 0:
+            print('Regressions against ' + baseline + ':')
+            for description in found:
+                print('  ' + description)
+            sys.exit(1)
+        print('No regressions against ' + baseline)
+
+
+if __name__ == '__main__':
+    main()
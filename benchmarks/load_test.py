@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""Load and soak test: many simulated users talking to one Core at once
+
+Each simulated user runs on its own thread and, after a random think time,
+sends either an utterance from the training corpora (data/mlb_XX.md), a button
+press (via Core.button_selection) or an empty input, all through Core.get_user
+and Core.check_input as the channels do.  Some users leave after each message
+and are replaced by new ones, so the user dictionary sees churn as it would in
+production.
+
+Reported: throughput, latency percentiles per kind of input and, sampled
+through the run, resident memory (RSS) and the size of the user dictionary.
+With --soak the run is meant to be long (eg --duration 3600) and memory that
+keeps growing after the warm up (the first --warm-up fraction of the samples)
+at more than --leak-threshold MB an hour is flagged as a leak (exit status 1).
+Idle users are only dropped from memory after the session time limit (10
+minutes), so with churn a soak run needs to be well beyond that for the user
+dictionary (and memory) to level off; --churn 0 keeps the same users throughout.
+
+Run from anywhere:  python benchmarks/load_test.py [--stub] [--users 50] [--duration 60]"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import datetime
+import platform
+import threading
+
+import click
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT_DIR)
+import util as u # some local utility functions
+from stub_interpreter import stub_loader, benchmark_config
+
+CORPUS_LANGS = ('en', 'fr', 'de')
+KINDS = ('utterance', 'button', 'empty')
+# latencies kept per kind of input for the percentiles (a random sample of them
+# once there are more, so a long soak run does not itself keep using more memory)
+RESERVOIR_SIZE = 5000
+
+
+def slope_per_hour(points):
+    """Least squares slope of (seconds, value) points, in value per hour"""
+    if len(points) < 2:
+        return 0.0
+    n = float(len(points))
+    mean_t = sum(t for t, v in points) / n
+    mean_v = sum(v for t, v in points) / n
+    var_t = sum((t - mean_t) ** 2 for t, v in points)
+    if var_t == 0:
+        return 0.0
+    return sum((t - mean_t) * (v - mean_v) for t, v in points) / var_t * 3600.0
+
+
+class Reservoir(object):
+    """A fixed size random sample of latencies, plus the count and maximum of all of them"""
+
+    def __init__(self, rng, size=RESERVOIR_SIZE):
+        self.rng = rng
+        self.size = size
+        self.samples = []
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.max = max(self.max, seconds)
+        if len(self.samples) < self.size:
+            self.samples.append(seconds)
+        else:
+            idx = self.rng.randrange(self.count)
+            if idx < self.size:
+                self.samples[idx] = seconds
+
+    def summary(self, elapsed):
+        summary = u.latency_summary(self.samples, elapsed)
+        summary['count'] = self.count
+        summary['throughput'] = (self.count / elapsed) if elapsed > 0 else 0.0
+        summary['max_ms'] = self.max * 1000.0
+        return summary
+
+
+class LoadTest(object):
+    """Drives a Core with simulated users and records what happens"""
+
+    def __init__(self, core, utterances, users, think_time, button_rate, empty_rate, churn, seed=0):
+        self.core = core
+        self.utterances = utterances
+        self.users = users
+        self.think_time = think_time
+        self.button_rate = button_rate
+        self.empty_rate = empty_rate
+        self.churn = churn
+        self.seed = seed
+        self.latencies = {kind: Reservoir(random.Random(seed)) for kind in KINDS}
+        self.all_latencies = Reservoir(random.Random(seed))
+        self.errors = 0
+        self.new_users = 0
+        self.samples = []   # dictionaries of elapsed, rss_mb, user_dict size and messages so far
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def messages(self):
+        with self._lock:
+            return self.all_latencies.count
+
+    def next_user_id(self):
+        with self._lock:
+            self.new_users += 1
+            return 'load-{n}'.format(n=self.new_users)
+
+    def send(self, rng, user):
+        """Sends one message from user, as the channels would
+
+        Return: the kind of message sent"""
+        self.core.update_user_stats(user)
+        pick = rng.random()
+        if pick < self.button_rate:
+            # one of the buttons shown (or, as a user can, a choice when there were none)
+            self.core.button_selection(':' + str(rng.randint(1, max(len(user['current_buttons']), 1))), user=user)
+            return 'button'
+        if pick < self.button_rate + self.empty_rate:
+            self.core.check_input('', user=user)
+            return 'empty'
+        self.core.check_input(rng.choice(self.utterances), user=user)
+        return 'utterance'
+
+    def run_user(self, idx):
+        rng = random.Random(self.seed + idx)
+        user = self.core.get_user(self.next_user_id())
+        timer = time.perf_counter
+        while not self._stop.is_set():
+            if self.think_time > 0:
+                if self._stop.wait(rng.expovariate(1.0 / self.think_time)):
+                    break
+            started = timer()
+            try:
+                kind = self.send(rng, user)
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                self.core.logger.error('Simulated user {user_id} hit an error: {e}'.format(user_id=user['user_id'], e=str(e)))
+                continue
+            elapsed = timer() - started
+            with self._lock:
+                self.latencies[kind].add(elapsed)
+                self.all_latencies.add(elapsed)
+            if rng.random() < self.churn:
+                user = self.core.get_user(self.next_user_id())
+
+    def sample(self, started):
+        self.samples.append({'elapsed_s': round(time.time() - started, 2), 'rss_mb': u.rss_mb(),
+            'users_in_memory': len(self.core.user_dict), 'messages': self.messages()})
+
+    def run(self, duration, sample_seconds):
+        threads = [threading.Thread(target=self.run_user, args=(idx,), name='load-user-{idx}'.format(idx=idx))
+            for idx in range(self.users)]
+        started = time.time()
+        self.sample(started)
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        while time.time() - started < duration:
+            time.sleep(min(sample_seconds, max(duration - (time.time() - started), 0.0)))
+            self.sample(started)
+        self._stop.set()
+        for thread in threads:
+            thread.join()
+        return time.time() - started
+
+
+def print_results(results):
+    print('{kind:<14}{count:>8}{tput:>14}{p50:>10}{p95:>10}{p99:>10}{max:>10}'.format(
+        kind='input', count='msgs', tput='per second', p50='p50 ms', p95='p95 ms', p99='p99 ms', max='max ms'))
+    for kind, s in results['latency'].items():
+        print('{kind:<14}{count:>8}{tput:>14.1f}{p50:>10.2f}{p95:>10.2f}{p99:>10.2f}{max:>10.2f}'.format(
+            kind=kind, count=s['count'], tput=s['throughput'], p50=s['p50_ms'], p95=s['p95_ms'], p99=s['p99_ms'], max=s['max_ms']))
+    print('')
+    print('{elapsed:>10}{rss:>10}{users:>10}{msgs:>10}'.format(elapsed='seconds', rss='RSS MB', users='users', msgs='msgs'))
+    for sample in results['samples']:
+        print('{elapsed:>10.1f}{rss:>10}{users:>10}{msgs:>10}'.format(elapsed=sample['elapsed_s'],
+            rss='-' if sample['rss_mb'] is None else '{0:.1f}'.format(sample['rss_mb']), users=sample['users_in_memory'], msgs=sample['messages']))
+    growth = results['growth']
+    print('')
+    print('Errors: {errors}   New users: {new_users}   RSS growth: {rss:.1f} MB/hour   User dictionary growth: {users:.0f} users/hour'.format(
+        errors=results['errors'], new_users=results['new_users'], rss=growth['rss_mb_per_hour'], users=growth['users_per_hour']))
+    if results['admission'] is not None:
+        print('Admission: ' + '   '.join('{name}: {n}'.format(name=name, n=n) for name, n in sorted(results['admission'].items())))
+
+
+@click.command()
+@click.option('--stub', is_flag=True, help='Use a stub in place of the trained interpreters.')
+@click.option('--users', default=20, help='Number of simulated users talking at once. Default is 20.')
+@click.option('--duration', default=60.0, help='Length of the run in seconds. Default is 60.')
+@click.option('--think-time', default=1.0, help='Mean seconds a user waits between messages (0 = none). Default is 1.')
+@click.option('--button-rate', default=0.2, help='Fraction of messages that are button presses. Default is 0.2.')
+@click.option('--empty-rate', default=0.05, help='Fraction of messages that are empty. Default is 0.05.')
+@click.option('--churn', default=0.01, help='Chance a user is replaced by a new one after each message. Default is 0.01.')
+@click.option('--with-cache', is_flag=True, help='Leave the parse cache on (it is off by default so every input is fully processed).')
+@click.option('--with-admission', is_flag=True, help='Apply the admission limits from the config (off by default).')
+@click.option('--with-log', is_flag=True, help='Leave the interaction log on (written to a throwaway file; it is off by default).')
+@click.option('--sample-seconds', default=5.0, help='Seconds between samples of memory and users. Default is 5.')
+@click.option('--soak', is_flag=True, help='Flag a memory leak (exit status 1) if RSS keeps growing after the warm up.')
+@click.option('--warm-up', default=0.2, help='Fraction of the samples ignored when looking for a leak. Default is 0.2.')
+@click.option('--leak-threshold', default=10.0, help='RSS growth in MB per hour counted as a leak. Default is 10.')
+@click.option('--seed', default=0, help='Random seed, so runs can be repeated. Default is 0.')
+@click.option('--out', 'out_file', default='load_results.json', help='JSON file to save the results to. Default is load_results.json.')
+def main(stub, users, duration, think_time, button_rate, empty_rate, churn, with_cache, with_admission, with_log, sample_seconds, soak, warm_up, leak_threshold, seed, out_file):
+    """Runs many simulated users against the bot, reporting throughput, latency and memory"""
+    out_file = os.path.abspath(out_file)
+    os.chdir(ROOT_DIR)
+
+    utterances = []
+    for lang in CORPUS_LANGS:
+        data_file = os.path.join('data', 'mlb_{lang}.md'.format(lang=lang))
+        if os.path.exists(data_file):
+            utterances.extend(text for intent, text in u.load_training_utterances(data_file))
+
+    from mlb import Core
+    config_file = benchmark_config(keep_cache=with_cache, keep_admission=with_admission, keep_log=with_log)
+    core = Core(channels_out={'screen': True}, loglvl='warn', config_override=config_file,
+        interpreter_loader=stub_loader if stub else None)
+    core.show_language = False
+    for lang in core.lang_interpreters:
+        if (core.parse_pool is None) or (lang not in core.parse_pool):
+            core.lang_interpreters.get(lang)   # loaded up front, so not part of the run
+
+    test = LoadTest(core, utterances, users, think_time, button_rate, empty_rate, churn, seed)
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as null_out:
+        core.out = null_out
+        sys.stdout = null_out
+        try:
+            elapsed = test.run(duration, sample_seconds)
+        finally:
+            core.out = stdout
+            sys.stdout = stdout
+    core.user_store.close()
+    if core.interaction_log is not None:
+        core.interaction_log.close()
+    shutil.rmtree(os.path.dirname(config_file), ignore_errors=True)
+
+    settled = test.samples[int(len(test.samples) * warm_up):]
+    rss_growth = slope_per_hour([(s['elapsed_s'], s['rss_mb']) for s in settled if s['rss_mb'] is not None])
+    users_growth = slope_per_hour([(s['elapsed_s'], s['users_in_memory']) for s in settled])
+    latency = {'all': test.all_latencies.summary(elapsed)}
+    for kind in KINDS:
+        latency[kind] = test.latencies[kind].summary(elapsed)
+    results = {'latency': latency, 'samples': test.samples, 'errors': test.errors, 'new_users': test.new_users,
+        'admission': core.admission.stats() if core.admission is not None else None,
+        'growth': {'rss_mb_per_hour': rss_growth, 'users_per_hour': users_growth},
+        'meta': {'time': datetime.datetime.now().isoformat(), 'python': platform.python_version(), 'stub': stub,
+            'users': users, 'duration': duration, 'think_time': think_time, 'button_rate': button_rate,
+            'empty_rate': empty_rate, 'churn': churn, 'with_cache': with_cache, 'with_admission': with_admission, 'with_log': with_log, 'seed': seed,
+            'detection_engine': core.detection_engine, 'langs_handled': sorted(core.langs_handled)}}
+    print_results(results)
+    with open(out_file, 'w') as results_out:
+        json.dump(results, results_out, indent=2)
+    print('Results saved to ' + out_file)
+
+    if soak:
+        if rss_growth > leak_threshold:
+            print('Possible memory leak: RSS grew by {rss:.1f} MB/hour after the warm up (threshold {threshold:.1f})'.format(
+                rss=rss_growth, threshold=leak_threshold))
+            sys.exit(1)
+        print('No memory leak found (RSS growth {rss:.1f} MB/hour, threshold {threshold:.1f})'.format(rss=rss_growth, threshold=leak_threshold))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Measures the memory used by each language's interpreter, loaded as Rasa NLU
+loads it (the full spaCy model) and as set by the "mlb_spacy" options in
+config/mlb_config_XX.json (unused spaCy components left out and the word
+vectors memory-mapped), or by LEAN_OPTIONS for a language without them
+
+Each interpreter is loaded in a fresh process, which then parses the
+utterances in data/mlb_XX.md so the pages actually used are counted.  RSS is
+the resident memory of the process; PSS (where /proc/self/smaps_rollup exists)
+splits shared pages, such as memory-mapped vectors, between the processes
+using them, so it is the better guide when several workers load one model.
+
+Needs the trained models (and spaCy).  Run from anywhere:
+    python benchmarks/model_memory.py [--lang en] [--processes 2]"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import multiprocessing
+
+import click
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT_DIR)
+import util as u # some local utility functions
+
+# lean loading measured for languages with no mlb_spacy options of their own
+LEAN_OPTIONS = {'disable': ['parser', 'ner'], 'vectors_mmap': True}
+
+
+def pss_mb():
+    """Proportional set size of this process in MB (None where unavailable)"""
+    try:
+        with open('/proc/self/smaps_rollup') as smaps:
+            for line in smaps:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def measure(lang, lean, barrier, results):
+    """Runs in a fresh process: loads the interpreter for lang and parses its
+    training utterances, putting the memory used on results"""
+    os.chdir(ROOT_DIR)
+    from interpreters import load_interpreter, spacy_options
+    rss_start = u.rss_mb()
+    started = time.time()
+    interpreter = load_interpreter(lang, (spacy_options(lang) or LEAN_OPTIONS) if lean else {})
+    load_seconds = time.time() - started
+    data_file = os.path.join('data', 'mlb_{lang}.md'.format(lang=lang))
+    for intent, text in u.load_training_utterances(data_file):
+        interpreter.parse(u.clean_input(text))
+    # wait for the other processes, so shared pages are counted between them all
+    barrier.wait()
+    results.put({'rss_mb': u.rss_mb() - rss_start, 'pss_mb': pss_mb(), 'load_seconds': load_seconds})
+    barrier.wait()
+
+
+def run(lang, lean, processes):
+    """Return: the average measurements over the processes"""
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(processes)
+    results = context.Queue()
+    workers = [context.Process(target=measure, args=(lang, lean, barrier, results)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    measured = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    average = {}
+    for key in ('rss_mb', 'pss_mb', 'load_seconds'):
+        values = [m[key] for m in measured if m[key] is not None]
+        average[key] = (sum(values) / len(values)) if len(values) > 0 else None
+    return average
+
+
+@click.command()
+@click.option('--lang', 'langs', multiple=True, help='Language to measure (can be given more than once). Default is every language with a trained model.')
+@click.option('--processes', default=1, help='Processes loading the same model at once (to see what is shared). Default is 1.')
+@click.option('--out', 'out_file', default='', help='JSON file to save the results to.')
+def main(langs, processes, out_file):
+    """Compares the memory used by full and lean interpreter loading"""
+    out_file = os.path.abspath(out_file) if out_file else ''
+    os.chdir(ROOT_DIR)
+    from interpreters import model_dir, spacy_options
+    if not langs:
+        langs = [lang for lang in ('en', 'fr', 'de') if os.path.isdir(model_dir(lang))]
+
+    results = {}
+    print('{lang:<6}{mode:<8}{rss:>12}{pss:>12}{load:>12}'.format(lang='lang', mode='loading', rss='RSS MB', pss='PSS MB', load='load s'))
+    for lang in langs:
+        results[lang] = {'options': spacy_options(lang) or LEAN_OPTIONS}
+        for mode, lean in (('full', False), ('lean', True)):
+            m = results[lang][mode] = run(lang, lean, processes)
+            print('{lang:<6}{mode:<8}{rss:>12.0f}{pss:>12}{load:>12.1f}'.format(lang=lang, mode=mode, rss=m['rss_mb'],
+                pss='-' if m['pss_mb'] is None else '{0:.0f}'.format(m['pss_mb']), load=m['load_seconds']))
+    if out_file:
+        with open(out_file, 'w') as results_out:
+            json.dump(results, results_out, indent=2)
+        print('Results saved to ' + out_file)
+
+
+if __name__ == '__main__':
+    main()
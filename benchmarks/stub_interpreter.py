@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""A stand-in for a Rasa NLU interpreter, so the benchmarks can run without the
+trained models (or spaCy) and measure MLB's own overhead"""
+
+import os
+import sys
+import configparser
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import util as u # some local utility functions
+
+DATA_FILE = os.path.join('data', 'mlb_{lang}.md')
+
+
+class StubInterpreter(object):
+    """Parses by looking the text up in the training data for its language:
+    known utterances get their intent with high confidence, others get a low
+    confidence guess (so both kinds of reply are exercised)"""
+
+    def __init__(self, lang):
+        self.lang = lang
+        self.known = {}
+        if os.path.exists(DATA_FILE.format(lang=lang)):
+            for intent, text in u.load_training_utterances(DATA_FILE.format(lang=lang)):
+                self.known[u.clean_input(text).lower()] = intent
+
+    def parse(self, text, time=None):
+        intent = self.known.get(text.lower())
+        if intent is None:
+            return {'text': text, 'intent': {'name': 'history', 'confidence': 0.1}, 'entities': []}
+        return {'text': text, 'intent': {'name': intent, 'confidence': 0.9}, 'entities': []}
+
+
+def stub_loader(lang):
+    return StubInterpreter(lang)
+
+
+def benchmark_config(config_file=os.path.join('config', 'mlb_config.ini'), keep_cache=False, keep_admission=False, keep_log=False):
+    """Writes a copy of the bot config for benchmarking: users are kept in a
+    throwaway pickle file, parsing happens in process (no worker pools), there
+    is no warm up or model watching, unless keep_cache, the parse cache and
+    session-sticky languages are off so every input is fully processed, unless
+    keep_admission, there are no admission limits and, unless keep_log, there
+    is no interaction log (if kept, it is written to the throwaway directory)
+
+    Return: the path of the copy"""
+    config = configparser.ConfigParser()
+    config.read([config_file])
+    work_dir = tempfile.mkdtemp(prefix='mlb_bench_')
+    config.set('files', 'history_file', os.path.join(work_dir, 'mlb.hist'))
+    config.set('files', 'pickle_file', os.path.join(work_dir, 'user_dict.pickle'))
+    if not config.has_section('users'):
+        config.add_section('users')
+    config.set('users', 'store', 'pickle')
+    config.remove_section('workers')
+    for section, option, value in (('startup', 'warm_up', 'false'), ('models', 'watch_seconds', '0')):
+        if config.has_section(section):
+            config.set(section, option, value)
+    if not keep_log:
+        config.remove_section('interaction_log')
+    elif config.has_section('interaction_log'):
+        config.set('interaction_log', 'file', os.path.join(work_dir, 'mlb_interactions.jsonl'))
+    if not keep_admission:
+        config.remove_section('admission')
+    if not keep_cache:
+        config.remove_section('cache')
+        if config.has_section('detection'):
+            config.set('detection', 'sticky_max_words', '0')
+    path = os.path.join(work_dir, 'mlb_config.ini')
+    with open(path, 'w') as config_out:
+        config.write(config_out)
+    return path
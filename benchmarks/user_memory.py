@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Memory benchmark: bytes per user held in memory, as dictionaries (the original
+representation in Core.get_user) and as UserRecords
+
+Run from the project root:  python benchmarks/user_memory.py [--users N]"""
+
+from __future__ import print_function
+
+import os
+import sys
+import datetime
+import tracemalloc
+
+import click
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from user_store import UserRecord
+
+
+def make_dict_user(user_id, now):
+    """A user as Core.get_user used to build them, after one interaction"""
+    new_user = {}
+    new_user['user_id'] = user_id
+    new_user['msg_output'] = ''
+    new_user['lang_selected'] = 'en'
+    new_user['last_interaction_time'] = now
+    new_user['this_interaction_time'] = now
+    new_user['input_counter'] = 1
+    new_user['session_counter'] = 1
+    new_user['total_sessions'] = 0
+    new_user['current_buttons'] = []
+    return new_user
+
+
+def make_record_user(user_id, now):
+    """The same user as a UserRecord"""
+    user = UserRecord(user_id)
+    user['last_interaction_time'] = now
+    user['this_interaction_time'] = now
+    user['input_counter'] = 1
+    user['session_counter'] = 1
+    return user
+
+
+def bytes_per_user(make_user, count):
+    user_ids = [str(i) for i in range(count)]  # ids are not counted
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    users = {}
+    for user_id in user_ids:
+        # a distinct datetime per user, as each user interacts at a different time
+        users[user_id] = make_user(user_id, datetime.datetime.now())
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return float(after - before) / count
+
+
+@click.command()
+@click.option('--users', default=100000, help='Number of users to create. Default is 100000.')
+def main(users):
+    """Reports the memory used per user by each representation"""
+    as_dict = bytes_per_user(make_dict_user, users)
+    as_record = bytes_per_user(make_record_user, users)
+    print('{users} users'.format(users=users))
+    print('  dict:       {b:8.1f} bytes per user'.format(b=as_dict))
+    print('  UserRecord: {b:8.1f} bytes per user ({pc:.0f}% of dict)'.format(b=as_record, pc=100.0 * as_record / as_dict))
+
+
+if __name__ == '__main__':
+    main()
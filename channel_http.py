@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""A simple asyncio HTTP input channel for MLB, so it can serve many users at once
+
+POST a JSON body of {"user_id": "...", "text": "..."} (to any path) and the
+reply comes back as JSON: {"user_id": "...", "reply": "...", "buttons": [...], "lang": "..."}
+A text of ':1', ':2' or ':3' selects one of the buttons from that user's last reply.
+GET /health returns {"status": "ok"} (eg for a load balancer) and GET /metrics
+returns the stage timings and counters in Prometheus text format.
+
+Language detection and parsing (the slow, blocking part of handling a message)
+run in a thread pool so the event loop keeps serving other requests meanwhile.
+Each request works on its own user's state and requests from the same user are
+handled one at a time, in order.  With admission control on, each message's
+rate is checked on arrival and it takes one of the max_in_flight places (or is
+turned away) once it is its user's turn, before it is handed to the thread
+pool, so the pool's own queue never holds more than max_in_flight messages.  Users
+are read from and saved to the user store on a thread of their own, so the
+event loop never waits on the store (nor on its flushes)."""
+
+import json
+import signal
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from admission import ADMITTED, DELAYED
+
+MAX_BODY_SIZE = 64 * 1024
+# on shutdown, how long requests already being handled are given to finish
+SHUTDOWN_SECONDS = 10.0
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large'}
+
+
+class HttpChannel(object):
+    """Serves a Core over HTTP"""
+
+    def __init__(self, core, host='127.0.0.1', port=8080, workers=4):
+        self.core = core
+        self.host = host
+        self.port = port
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # the user store (and the users in memory) are only used from this thread
+        self.store_executor = ThreadPoolExecutor(max_workers=1)
+        self.user_locks = {}    # user_id -> [asyncio.Lock, number of requests using it]
+        self.connections = {}   # connection task -> whether it is handling a request
+        self.closing = False
+
+    def button_text(self, text, user):
+        """Turns a button selection (eg ':2') into the text of that button"""
+        choice = text.strip()
+        if choice in (':1', ':2', ':3'):
+            idx = int(choice[1:]) - 1
+            if idx < len(user['current_buttons']):
+                return user['current_buttons'][idx]
+            return ''
+        return text
+
+    async def handle_message(self, user_id, text):
+        """Handles one message from a user, returning the reply to send back"""
+        admission = self.core.admission
+        # the user's rate is checked on arrival, but a place is only taken once it is this message's turn
+        decision = await admission.take_token_async(user_id) if admission is not None else None
+        lock_entry = self.user_locks.setdefault(user_id, [asyncio.Lock(), 0])
+        lock_entry[1] += 1
+        try:
+            async with lock_entry[0]:
+                loop = asyncio.get_event_loop()
+                user = await loop.run_in_executor(self.store_executor, self.core.get_user, user_id)
+                user['msg_output'] = ''
+                self.core.update_user_stats(user)
+                text = self.button_text(text, user)
+                if decision in (ADMITTED, DELAYED):
+                    decision = await admission.acquire_slot_async(decision)
+                if decision in (None, ADMITTED, DELAYED):
+                    try:
+                        resp = await loop.run_in_executor(self.executor, self.core.parse_input, text, user, decision)
+                    finally:
+                        if decision is not None:
+                            admission.release()
+                else:
+                    # turned away, which needs no thread
+                    resp = self.core.parse_input(text, user, decision)
+                self.core.respond(resp, user=user)
+                await loop.run_in_executor(self.store_executor, self.core.save_user, user)
+                reply = {'user_id': user_id, 'reply': user['msg_output'].rstrip('\n'),
+                    'buttons': list(user['current_buttons']), 'lang': user['lang_selected']}
+                user['msg_output'] = ''
+                return reply
+        finally:
+            lock_entry[1] -= 1
+            if lock_entry[1] == 0:
+                del self.user_locks[user_id]
+
+    async def dispatch(self, method, path, body):
+        """Routes a request, returning the status code and the JSON payload"""
+        if method == 'GET':
+            if path == '/health':
+                return 200, {'status': 'ok'}
+            if path == '/metrics':
+                return 200, self.core.metrics.to_prometheus()
+            return 404, {'error': 'not found'}
+        if method != 'POST':
+            return 405, {'error': 'only GET /health, GET /metrics and POST are supported'}
+        try:
+            message = json.loads(body.decode('utf-8'))
+            user_id = str(message['user_id'])
+            text = message['text']
+            if not isinstance(text, str):
+                raise ValueError('text must be a string')
+        except (ValueError, KeyError, TypeError, UnicodeDecodeError) as e:
+            return 400, {'error': 'expected JSON with user_id and text (' + str(e) + ')'}
+        return 200, await self.handle_message(user_id, text)
+
+    def write_response(self, writer, status, payload, keep_alive):
+        """Writes the response: payload is sent as JSON, or as plain text if it is a string"""
+        if isinstance(payload, str):
+            body = payload.encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        else:
+            body = json.dumps(payload).encode('utf-8')
+            content_type = 'application/json; charset=utf-8'
+        head = ('HTTP/1.1 {status} {text}\r\n'
+            'Content-Type: {content_type}\r\n'
+            'Content-Length: {length}\r\n'
+            'Connection: {connection}\r\n\r\n').format(status=status, text=STATUS_TEXT.get(status, ''), content_type=content_type,
+                length=len(body), connection='keep-alive' if keep_alive else 'close')
+        writer.write(head.encode('latin-1') + body)
+
+    async def handle_connection(self, reader, writer):
+        """Reads requests from a connection (several if kept alive) and answers them"""
+        task = asyncio.current_task()
+        self.connections[task] = False
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                self.connections[task] = True
+                try:
+                    method, path, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    self.write_response(writer, 400, {'error': 'bad request line'}, False)
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                keep_alive = (version == 'HTTP/1.1') and (headers.get('connection', '').lower() != 'close') and not self.closing
+                try:
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    length = -1
+                if (length < 0) or (length > MAX_BODY_SIZE):
+                    self.write_response(writer, 413 if length > 0 else 400, {'error': 'bad content length'}, False)
+                    break
+                body = await reader.readexactly(length) if length > 0 else b''
+
+                status, payload = await self.dispatch(method.upper(), path, body)
+                keep_alive = keep_alive and not self.closing
+                self.write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                self.connections[task] = False
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # (cancelled when the server is stopping)
+            pass
+        except Exception as e:
+            self.core.logger.error('Error handling HTTP request: ' + str(e))
+        finally:
+            del self.connections[task]
+            writer.close()
+
+    async def drain(self, timeout=SHUTDOWN_SECONDS):
+        """Lets the requests being handled finish (for up to timeout seconds) and
+        closes the idle connections, cancelling whatever is left after that"""
+        self.closing = True
+        for task, busy in list(self.connections.items()):
+            if not busy:
+                task.cancel()
+        tasks = list(self.connections)
+        if len(tasks) == 0:
+            return
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        if len(pending) > 0:
+            self.core.logger.warn('Gave up waiting for {count} HTTP requests to finish'.format(count=len(pending)))
+            for task in pending:
+                task.cancel()
+            await asyncio.wait(pending)
+
+    def serve(self):
+        """Runs the server until the programme is stopped (by SIGINT or SIGTERM),
+        then stops taking connections and lets the requests being handled finish,
+        so their users are saved, before returning (the caller then closes the Core)"""
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = loop.run_until_complete(asyncio.start_server(self.handle_connection, self.host, self.port))
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, loop.stop)
+            except (NotImplementedError, RuntimeError):
+                # eg on Windows, or not in the main thread: stopping is left to the Core's own handler
+                pass
+        self.core.logger.info('HTTP channel listening on {host}:{port}'.format(host=self.host, port=self.port))
+        try:
+            loop.run_forever()
+        finally:
+            self.core.logger.info('HTTP channel stopping')
+            server.close()
+            loop.run_until_complete(self.drain())
+            loop.run_until_complete(server.wait_closed())
+            self.executor.shutdown(wait=True)
+            self.store_executor.shutdown(wait=True)
+            loop.close()
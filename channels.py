@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""Output channels: where the bot's replies (and their buttons) are sent
+
+Each channel renders a reply once, into a single string or message, and hands
+it over in one go:
+    ScreenChannel: writes to the terminal (or whatever stream it is given), with
+        the colour styling only when that stream is a terminal
+    ReplyChannel: collects the reply on the user (msg_output) for the http input
+        channel to return
+    WebhookChannel: POSTs the reply as JSON to a URL from a background thread,
+        so a slow remote end never holds up parsing"""
+
+import sys
+import json
+import queue
+import threading
+
+from colored import style
+
+import util as u # some local utility functions
+
+
+class OutputChannel(object):
+    """Base class: send is called with every reply (and does nothing here)
+
+    echo: True for the echo of a user's own input (eg a button choice), which
+        only makes sense on screen"""
+
+    name = None
+
+    def send(self, user, text, buttons=(), echo=False, out=None):
+        pass
+
+    def close(self):
+        pass
+
+
+class ScreenChannel(OutputChannel):
+    """Replies written to a stream (stdout unless given another)"""
+
+    name = 'screen'
+
+    STYLED_ECHO = '\n\t\t' + u.STY_CURSOR + ' > ' + u.STY_USER + '{text}' + style.RESET + '\n'
+    PLAIN_ECHO = '\n\t\t > {text}\n'
+    STYLED_REPLY = '\n\t' + u.STY_RECIPIENT + '  User: {user_id}  ' + u.STY_USER + '\t' + u.STY_RESP + '  {text}  ' + u.STY_USER + '\n\n'
+    PLAIN_REPLY = '\n\t  User: {user_id}  \t  {text}  \n\n'
+
+    def __init__(self, out=None):
+        self.out = out
+
+    def render(self, user, text, buttons=(), echo=False, styled=True):
+        """Return: the whole of the output for a reply, as one string"""
+        if echo:
+            return (self.STYLED_ECHO if styled else self.PLAIN_ECHO).format(text=text)
+        output = (self.STYLED_REPLY if styled else self.PLAIN_REPLY).format(user_id=user['user_id'], text=text)
+        if len(buttons) > 0:
+            output += '\t\t' + ''.join('\t[{n}] {button}'.format(n=idx + 1, button=button) for idx, button in enumerate(buttons)) + '\n\n'
+        return output
+
+    def send(self, user, text, buttons=(), echo=False, out=None):
+        out = out or self.out or sys.stdout
+        isatty = getattr(out, 'isatty', None)
+        out.write(self.render(user, text, buttons, echo, styled=(isatty is not None) and isatty()))
+        out.flush()
+
+
+class ReplyChannel(OutputChannel):
+    """Replies collected per user (in msg_output) to go back as the response to
+    the request that prompted them"""
+
+    name = 'http'
+
+    def send(self, user, text, buttons=(), echo=False, out=None):
+        if echo or (len(text) == 0):
+            return
+        user['msg_output'] = user['msg_output'] + text + '\n'
+
+
+class WebhookChannel(OutputChannel):
+    """Replies POSTed as JSON ({"user_id": ..., "text": ..., "buttons": [...]})
+    to a URL by a background thread. If the queue of replies waiting to go is
+    full, new ones are dropped (and counted) rather than waiting."""
+
+    name = 'webhook'
+
+    def __init__(self, url, logger, metrics=None, max_queue=1000, timeout=5.0):
+        self.url = url
+        self.logger = logger
+        self.metrics = metrics
+        self.timeout = timeout
+        self.queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._deliver, name='webhook-sender')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, user, text, buttons=(), echo=False, out=None):
+        if echo or (len(text) == 0):
+            return
+        body = json.dumps({'user_id': user['user_id'], 'text': text, 'buttons': list(buttons)}).encode('utf-8')
+        try:
+            self.queue.put_nowait(body)
+        except queue.Full:
+            if self.metrics is not None:
+                self.metrics.count('webhook_dropped')
+
+    def _deliver(self):
+        # only imported when there is a webhook, as it is slow to import
+        import urllib.request
+        while True:
+            body = self.queue.get()
+            if body is None:
+                break
+            request = urllib.request.Request(self.url, data=body, headers={'Content-Type': 'application/json; charset=utf-8'})
+            try:
+                urllib.request.urlopen(request, timeout=self.timeout).close()
+            except Exception as e:
+                self.logger.warn('Unable to send reply to {url}: {e}'.format(url=self.url, e=str(e)))
+                if self.metrics is not None:
+                    self.metrics.count('webhook_failed')
+
+    def close(self, timeout=5.0):
+        """Sends what is waiting (for up to timeout seconds) and stops the sender"""
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""Evaluation of intent accuracy and routing, so a change to the training data
+(or anything else) can be checked for both accuracy and speed
+
+Two checks are made:
+    cross-validation: each language's intent classifier is trained k times, on
+        all but one fold of its training data, and tested on the fold left out
+        (the languages are done at the same time, each in its own process)
+    routing: every utterance in every language's training data goes through the
+        bot's full path (language detection, routing to an interpreter and the
+        response, as check_input does), timing each one and noting whether it
+        reached the right language and intent
+
+The results for each language are confusion matrices (expected intent against
+predicted), accuracy, the misroute rate (utterances sent to the wrong language)
+and latency percentiles."""
+
+import time
+import random
+import multiprocessing
+from collections import Counter
+
+import util as u # some local utility functions
+from training import find_jobs
+
+
+def confusion_matrix(pairs):
+    """Return: {expected: {predicted: count}} from a list of (expected, predicted)"""
+    matrix = {}
+    for (expected, predicted), count in Counter(pairs).items():
+        matrix.setdefault(expected, {})[str(predicted)] = count
+    return matrix
+
+
+def accuracy(pairs):
+    return (sum(1 for expected, predicted in pairs if expected == predicted) / len(pairs)) if len(pairs) > 0 else 0.0
+
+
+def split_folds(examples, folds, seed=0):
+    """Splits the examples into folds with each intent spread evenly across them
+
+    Return: list of folds (lists of examples)"""
+    rng = random.Random(seed)
+    by_intent = {}
+    for example in examples:
+        by_intent.setdefault(example.get('intent'), []).append(example)
+    split = [[] for fold in range(folds)]
+    idx = 0
+    for intent in sorted(by_intent):
+        group = by_intent[intent]
+        rng.shuffle(group)
+        for example in group:
+            split[idx % folds].append(example)
+            idx += 1
+    return split
+
+
+def cross_validate(config_file, folds=5, seed=0):
+    """k-fold cross-validation of the intent classifier for one language (run in
+    a separate process by start_cross_validation)
+
+    Return: dictionary of the accuracy (overall and per fold), confusion matrix
+    and parse latency"""
+    # imported here as they are slow and only needed in the evaluation processes
+    from rasa_nlu.components import ComponentBuilder
+    from rasa_nlu.config import RasaNLUConfig
+    from rasa_nlu.converters import load_data
+    from rasa_nlu.model import Trainer
+    from rasa_nlu.training_data import TrainingData
+
+    started = time.time()
+    config = RasaNLUConfig(config_file)
+    data = load_data(config['data'], config['language'])
+    split = split_folds(data.intent_examples, folds, seed)
+    # the same spaCy model etc is used for every fold
+    builder = ComponentBuilder(use_cache=True)
+    pairs = []
+    fold_accuracy = []
+    latencies = []
+    for test_idx, test in enumerate(split):
+        if len(test) == 0:
+            continue
+        train = [example for idx, fold in enumerate(split) if idx != test_idx for example in fold]
+        interpreter = Trainer(config, builder).train(TrainingData(train, data.entity_synonyms, data.regex_features))
+        fold_pairs = []
+        for example in test:
+            parse_started = time.perf_counter()
+            resp = interpreter.parse(example.text)
+            latencies.append(time.perf_counter() - parse_started)
+            fold_pairs.append((example.get('intent'), (resp.get('intent') or {}).get('name')))
+        fold_accuracy.append(accuracy(fold_pairs))
+        pairs.extend(fold_pairs)
+    return {'folds': len(fold_accuracy), 'examples': len(pairs), 'accuracy': accuracy(pairs),
+        'fold_accuracy': fold_accuracy, 'confusion': confusion_matrix(pairs),
+        'parse_latency': u.latency_summary(latencies), 'seconds': time.time() - started}
+
+
+def start_cross_validation(langs=None, folds=5, processes=0, seed=0):
+    """Starts cross_validate for each language (or just langs) in a pool of processes
+
+    Return: the pool and a dictionary of lang -> AsyncResult"""
+    jobs = find_jobs(langs)
+    processes = processes if processes > 0 else min(max(len(jobs), 1), multiprocessing.cpu_count())
+    pool = multiprocessing.Pool(processes=processes)
+    pending = {job.lang: pool.apply_async(cross_validate, (job.config_file, folds, seed)) for job in jobs}
+    pool.close()
+    return pool, pending
+
+
+def evaluate_routing(core, langs=None, user_id='evaluate'):
+    """Sends every training utterance of each language (or just langs) through
+    parse_input and respond, as check_input does (without saving the user), and
+    times each one. Anything that would affect the results or be affected by
+    them (the parse cache, admission control, the interaction log and output,
+    including to screen) is turned off first, and the interpreters are loaded
+    up front.
+
+    Return: dictionary of lang -> results, with each utterance's results under 'utterances'"""
+    core.parse_cache = None
+    core.admission = None
+    if core.interaction_log is not None:
+        core.interaction_log.close()
+        core.interaction_log = None
+    for channel in core.output_channels:
+        channel.close()
+    core.output_channels = []
+    core.CHANNELS_OUT = {}
+    core.get_lang_identifier()
+    for lang in core.lang_interpreters:
+        core.lang_interpreters[lang]
+    user = core.get_user(user_id)
+
+    results = {}
+    for job in find_jobs(langs):
+        utterances = []
+        for intent, text in u.load_training_utterances(job.data_file):
+            # each utterance is judged on its own, without keeping to the language of the one before
+            user['lang_session'] = None
+            started = time.perf_counter()
+            resp = core.parse_input(text, user)
+            core.respond(resp, user=user)
+            elapsed = time.perf_counter() - started
+            predicted = ((resp or {}).get('intent') or {}).get('name')
+            utterances.append({'text': text, 'intent': intent, 'lang': user['lang_selected'], 'predicted': predicted,
+                'confidence': float(((resp or {}).get('intent') or {}).get('confidence') or 0.0), 'ms': elapsed * 1000.0})
+        routed = Counter(utterance['lang'] for utterance in utterances)
+        pairs = [(utterance['intent'], utterance['predicted']) for utterance in utterances]
+        results[job.lang] = {'examples': len(utterances), 'handled': job.lang in core.lang_interpreters,
+            'misroute_rate': (1.0 - routed[job.lang] / len(utterances)) if len(utterances) > 0 else 0.0,
+            'routed_to': dict(routed), 'accuracy': accuracy(pairs),
+            'accuracy_when_routed': accuracy([pair for pair, utterance in zip(pairs, utterances) if utterance['lang'] == job.lang]),
+            'confusion': confusion_matrix(pairs),
+            'latency': u.latency_summary([utterance['ms'] / 1000.0 for utterance in utterances]),
+            'utterances': utterances}
+    return results
+
+
+def print_confusion(matrix, out):
+    labels = sorted(set(matrix) | set(predicted for row in matrix.values() for predicted in row))
+    width = max([len(label) for label in labels] + [8]) + 2
+    out.write('\t' + 'expected'.ljust(width) + ''.join(label.rjust(width) for label in labels) + '\n')
+    for expected in sorted(matrix):
+        out.write('\t' + expected.ljust(width) + ''.join(str(matrix[expected].get(label, 0)).rjust(width) for label in labels) + '\n')
+
+
+def print_results(results, out):
+    """Writes a readable summary of the results of evaluate (as returned by the command)"""
+    for lang in sorted(set(results['cross_validation']) | set(results['routing'])):
+        out.write('\n== {lang} ==\n'.format(lang=lang))
+        cv = results['cross_validation'].get(lang)
+        if cv is not None:
+            out.write('Cross-validation ({folds} folds, {n} examples, {secs:.1f}s): accuracy {acc:.1%} (folds: {folds_acc})\n'.format(
+                folds=cv['folds'], n=cv['examples'], secs=cv['seconds'], acc=cv['accuracy'],
+                folds_acc=', '.join('{0:.1%}'.format(acc) for acc in cv['fold_accuracy'])))
+            print_confusion(cv['confusion'], out)
+        routing = results['routing'].get(lang)
+        if routing is not None:
+            if not routing['handled']:
+                out.write('NB: {lang} is not one of the languages the bot handles\n'.format(lang=lang))
+            out.write('Routing ({n} utterances): misrouted {misroute:.1%} ({routed}), intent accuracy {acc:.1%} ({acc_routed:.1%} when routed correctly)\n'.format(
+                n=routing['examples'], misroute=routing['misroute_rate'], acc=routing['accuracy'], acc_routed=routing['accuracy_when_routed'],
+                routed=', '.join('{lang}: {n}'.format(lang=lang, n=n) for lang, n in sorted(routing['routed_to'].items()))))
+            out.write('Latency: p50 {p50_ms:.2f} ms, p95 {p95_ms:.2f} ms, p99 {p99_ms:.2f} ms, max {max_ms:.2f} ms\n'.format(**routing['latency']))
+            print_confusion(routing['confusion'], out)
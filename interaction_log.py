@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""A structured (JSONL) log of every input handled, written off the hot path
+
+Each input is traced as it is handled (see Trace) and the resulting record
+is put on a queue; a background thread takes the records off in batches,
+encodes and writes them, and rotates the file once it reaches max_bytes (the
+old file is gzipped, keeping up to backups of them).  If the writer falls
+behind and the queue fills up, records are dropped (and counted) rather than
+ever making a reply wait."""
+
+import os
+import time
+import json
+import datetime
+import gzip
+import queue
+import shutil
+import threading
+
+
+class Trace(object):
+    """What happened to one input, built up as it is handled"""
+
+    __slots__ = ('fields', 'timings', 'started', 'last')
+
+    def __init__(self):
+        self.fields = {}
+        self.timings = {}
+        self.started = self.last = time.perf_counter()
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def mark(self, stage, elapsed=None):
+        """Records the time taken by stage: elapsed (in seconds, as returned by
+        Metrics.stop, so a stage is not timed twice) or, when that is None (ie
+        metrics are disabled), the time since the last mark (or the start)"""
+        if elapsed is None:
+            now = time.perf_counter()
+            elapsed = now - self.last
+            self.last = now
+        self.timings[stage] = self.timings.get(stage, 0.0) + round(elapsed * 1000.0, 3)
+
+    def record(self, user, resp):
+        """Return: the log record for the input, given the parse response"""
+        record = {'time': datetime.datetime.now().isoformat(timespec='milliseconds'), 'user_id': user['user_id'], 'lang': user['lang_selected'],
+            'intent': None, 'confidence': None, 'entities': []}
+        record.update(self.fields)
+        if resp:
+            intent = resp.get('intent') or {}
+            record['intent'] = intent.get('name')
+            record['confidence'] = intent.get('confidence')
+            record['entities'] = resp.get('entities', [])
+        record['timings_ms'] = self.timings
+        record['total_ms'] = round((time.perf_counter() - self.started) * 1000.0, 3)
+        return record
+
+
+class _NoTrace(object):
+    """Stands in for a Trace when there is no interaction log, doing nothing"""
+
+    def set(self, **fields):
+        pass
+
+    def mark(self, stage, elapsed=None):
+        pass
+
+
+NO_TRACE = _NoTrace()
+
+
+def _json_default(value):
+    # eg numpy floats in parse responses
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+class InteractionLog(object):
+    """Appends records to a JSONL file from a background thread
+
+    max_bytes: size at which the file is rotated (0 = never)
+    backups: number of gzipped old files kept
+    batch_size: most records written at once
+    flush_seconds: longest a record waits to be written
+    max_queue: records allowed to wait before new ones are dropped"""
+
+    def __init__(self, path, logger, max_bytes=50 * 1024 * 1024, backups=5, batch_size=100, flush_seconds=1.0, max_queue=10000):
+        self.path = path
+        self.logger = logger
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.written = 0
+        self.dropped = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.log_out = open(path, 'a', encoding='utf-8')
+        self._thread = threading.Thread(target=self._write, name='interaction-log')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def log(self, record):
+        """Queues a record to be written (never blocks)"""
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _next_batch(self):
+        """Waits for a record, then takes any more that arrive within flush_seconds
+
+        Return: the records and whether the log is closing"""
+        batch = []
+        record = self.queue.get()
+        deadline = time.time() + self.flush_seconds
+        while record is not None:
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                break
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                record = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+        return batch, record is None
+
+    def _write(self):
+        closing = False
+        while not closing:
+            batch, closing = self._next_batch()
+            if len(batch) == 0:
+                continue
+            try:
+                self.log_out.write(''.join(json.dumps(record, ensure_ascii=False, default=_json_default) + '\n' for record in batch))
+                self.log_out.flush()
+                self.written += len(batch)
+                if (self.max_bytes > 0) and (self.log_out.tell() >= self.max_bytes):
+                    self.rotate()
+            except (IOError, OSError, ValueError) as e:
+                self.logger.warn('Problem writing interaction log: ' + str(e))
+        self.log_out.close()
+
+    def rotate(self):
+        """Gzips the current file to path.1.gz (moving older ones along) and starts a new one"""
+        self.log_out.close()
+        if self.backups > 0:
+            for idx in range(self.backups - 1, 0, -1):
+                older = '{path}.{idx}.gz'.format(path=self.path, idx=idx)
+                if os.path.exists(older):
+                    os.replace(older, '{path}.{idx}.gz'.format(path=self.path, idx=idx + 1))
+            with open(self.path, 'rb') as log_in, gzip.open(self.path + '.1.gz', 'wb') as gz_out:
+                shutil.copyfileobj(log_in, gz_out)
+        os.remove(self.path)
+        self.log_out = open(self.path, 'a', encoding='utf-8')
+
+    def close(self, timeout=5.0):
+        """Writes what is waiting (for up to timeout seconds) and stops the writer"""
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+        if self.dropped > 0:
+            self.logger.warn('Interaction log dropped {count} records'.format(count=self.dropped))
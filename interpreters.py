@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+"""Loading and management of the per-language Rasa NLU interpreters.
+
+Interpreters are only loaded when a message is first routed to their language
+and the least recently used ones are evicted once the configured limits
+(number of resident interpreters and / or memory budget) are exceeded.
+Retrained models can be swapped in whilst the bot is running (see reload and
+ModelWatcher)."""
+
+import os
+import gc
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import util as u # some local utility functions
+
+MODEL_DIR = os.path.join('projects', 'default', 'current_{lang}')
+LANG_CONFIG_FILE = os.path.join('config', 'mlb_config_{lang}.json')
+
+
+def model_dir(lang):
+    """Returns the directory that the trained model for a language is stored in"""
+    return MODEL_DIR.format(lang=lang)
+
+
+def model_version(lang):
+    """Returns a value that changes whenever the model for a language is retrained
+    (the modification time of its metadata), or None if there is no model"""
+    for path in (os.path.join(model_dir(lang), 'metadata.json'), model_dir(lang)):
+        if os.path.exists(path):
+            return os.path.getmtime(path)
+    return None
+
+
+def spacy_options(lang):
+    """Returns the "mlb_spacy" options from the config for a language (how its
+    spaCy model should be loaded, see lean_component_builder), if any"""
+    try:
+        with open(LANG_CONFIG_FILE.format(lang=lang), encoding='utf-8') as config_in:
+            return json.load(config_in).get('mlb_spacy') or {}
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def mmap_vectors(nlp):
+    """Swaps the word vectors of a loaded spaCy model for a read-only memory map
+    of the vectors file in the model's directory, so the copy read in can be
+    freed and processes loading the same model share its pages
+
+    Return: True if the vectors are now memory-mapped"""
+    import numpy
+    if nlp.path is None:
+        return False
+    path = nlp.path / 'vocab' / 'vectors'
+    if not path.exists():
+        return False
+    data = numpy.load(str(path), mmap_mode='r')
+    if data.shape != nlp.vocab.vectors.data.shape:
+        return False
+    nlp.vocab.vectors.data = data
+    return True
+
+
+def load_spacy(model_name, disable=(), vectors_mmap=False):
+    """Loads a spaCy model without the pipeline components in disable (eg
+    parser and ner, which none of the Rasa NLU components used here need) and
+    optionally with its vectors memory-mapped"""
+    import spacy
+    nlp = spacy.load(model_name, disable=list(disable))
+    if vectors_mmap and (not mmap_vectors(nlp)):
+        logging.getLogger('root').warning('Could not memory map the vectors of spaCy model ' + model_name)
+    return nlp
+
+
+def lean_component_builder(lang, options):
+    """Returns a Rasa NLU ComponentBuilder with its nlp_spacy component already
+    made from a spaCy model loaded as options say, so Interpreter.load uses it
+    rather than loading the full model itself
+
+    options: dictionary with "disable" (list of spaCy pipeline components not to
+        load) and "vectors_mmap" (whether to memory map the word vectors)"""
+    from rasa_nlu.components import ComponentBuilder
+    from rasa_nlu.model import Metadata
+    from rasa_nlu.utils.spacy_utils import SpacyNLP
+    metadata = Metadata.load(model_dir(lang))
+    # (the pipeline is recorded by class path, or by name in older models)
+    if not any((name == 'nlp_spacy') or name.endswith('.SpacyNLP') for name in metadata.pipeline):
+        return None
+    spacy_model_name = metadata.get('spacy_model_name') or metadata.language
+    nlp = load_spacy(spacy_model_name, options.get('disable', ()), options.get('vectors_mmap', False))
+    SpacyNLP.ensure_proper_language_model(nlp)
+    builder = ComponentBuilder(use_cache=True)
+    builder.component_cache[SpacyNLP.cache_key(metadata)] = SpacyNLP(nlp, metadata.language, spacy_model_name)
+    logging.getLogger('root').debug('Loaded spaCy model {name} for {lang} with pipeline: {pipes}'.format(
+        name=spacy_model_name, lang=lang, pipes=', '.join(nlp.pipe_names)))
+    return builder
+
+
+def load_interpreter(lang, options=None):
+    """Loads the trained Rasa NLU interpreter for a language
+
+    (rasa_nlu, which brings in spaCy, sklearn etc, is imported here on first use
+    as importing it takes several seconds)
+
+    options: how to load the spaCy model (defaults to the "mlb_spacy" options
+        in the language's config; {} loads it as Rasa NLU would)"""
+    started = time.time()
+    from rasa_nlu.model import Interpreter
+    from rasa_nlu.config import RasaNLUConfig
+    logging.getLogger('root').debug('Imported rasa_nlu in {secs:.3f}s'.format(secs=time.time() - started))
+    if options is None:
+        options = spacy_options(lang)
+    builder = None
+    if options:
+        try:
+            builder = lean_component_builder(lang, options)
+        except Exception as e:
+            logging.getLogger('root').warning('Loading the spaCy model for {lang} as usual (could not load it lean: {e})'.format(lang=lang, e=str(e)))
+    return Interpreter.load(model_dir(lang), RasaNLUConfig(LANG_CONFIG_FILE.format(lang=lang)), builder)
+
+
+class InterpreterManager(object):
+    """Keeps the interpreters for the handled languages, loading them on demand
+
+    It behaves like a read-only dictionary of lang -> interpreter for the
+    languages handled, so 'lang in manager' is True for every handled language
+    whether or not its interpreter is currently loaded.
+
+    max_loaded: maximum number of interpreters resident at once (0 = no limit)
+    max_memory_mb: memory budget for the resident interpreters (0 = no limit),
+        based on the growth in process memory seen whilst loading each one
+    metrics: optional Metrics that loads and evictions are counted in
+        (model_load and model_evict, per language)"""
+
+    def __init__(self, langs_handled, max_loaded=0, max_memory_mb=0, loader=load_interpreter, logger=None, metrics=None):
+        self.langs_handled = langs_handled
+        self.max_loaded = max_loaded
+        self.max_memory_mb = max_memory_mb
+        self.loader = loader
+        self.logger = logger or logging.getLogger('root')
+        self.metrics = metrics
+
+        self.loaded = OrderedDict() # lang -> interpreter, least recently used first
+        self.footprint_mb = {}  # lang -> approximate memory used by its interpreter
+        self.versions = {}      # lang -> model_version of the model last loaded
+        self.warming = set()    # langs waiting to be loaded by warm_up
+        # functions called with lang when a different model is loaded for it
+        self.model_change_listeners = []
+
+        self._lock = threading.RLock()
+        self._lang_locks = {lang: threading.Lock() for lang in langs_handled}
+        self._parse_locks = {lang: threading.Lock() for lang in langs_handled}
+
+    def __contains__(self, lang):
+        return lang in self.langs_handled
+
+    def __iter__(self):
+        return iter(self.langs_handled)
+
+    def __len__(self):
+        return len(self.langs_handled)
+
+    def __getitem__(self, lang):
+        return self.get(lang)
+
+    def model_exists(self, lang):
+        """Checks the trained model for a language is present (without loading it)"""
+        return os.path.isdir(model_dir(lang))
+
+    def is_ready(self, lang):
+        """False only while lang is waiting to be loaded by warm_up"""
+        with self._lock:
+            return (lang not in self.warming) or (lang in self.loaded)
+
+    def warm_up(self, langs, text='hello', before=None):
+        """Loads the interpreters for langs on a background thread, running a
+        dummy parse through each so that the first real parse is not slow
+
+        before: optional function to call first on the thread
+
+        Return: the thread"""
+        with self._lock:
+            self.warming = set(langs)
+
+        def run():
+            started = time.time()
+            if before is not None:
+                before()
+            for lang in langs:
+                try:
+                    self.parse(lang, text)
+                    self.logger.debug('Warmed up {language} after {secs:.3f}s'.format(language=self.langs_handled[lang], secs=time.time() - started))
+                except Exception as e:
+                    self.logger.error('Error warming up interpreter for {language} (lang: {lang}): {e}'.format(language=self.langs_handled[lang], lang=lang, e=str(e)))
+                finally:
+                    with self._lock:
+                        self.warming.discard(lang)
+
+        thread = threading.Thread(target=run, name='warm-up')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def get(self, lang):
+        """Returns the interpreter for lang, loading it first if it is not resident"""
+        if lang not in self.langs_handled:
+            raise KeyError(lang)
+        with self._lock:
+            if lang in self.loaded:
+                self.loaded.move_to_end(lang)
+                return self.loaded[lang]
+
+        # Only one thread loads a given language; others asking for it wait here
+        with self._lang_locks[lang]:
+            with self._lock:
+                if lang in self.loaded:
+                    self.loaded.move_to_end(lang)
+                    return self.loaded[lang]
+            interpreter, version = self._load(lang)
+            self._swap_in(lang, interpreter, version)
+            return interpreter
+
+    def reload(self, lang, force=False):
+        """Loads the current model for lang to replace the resident interpreter,
+        which carries on serving parses until the new one is swapped in (so for
+        a while both are in memory).  Languages that are not loaded are left to
+        pick up the current model when next used.
+
+        force: reload even if the model has not changed
+
+        Return: True if a new interpreter was swapped in"""
+        with self._lang_locks[lang]:
+            with self._lock:
+                if lang not in self.loaded:
+                    return False
+                if (not force) and (self.versions.get(lang) == model_version(lang)):
+                    return False
+            interpreter, version = self._load(lang)
+            self._swap_in(lang, interpreter, version)
+        self.logger.info('Reloaded interpreter for {language} (lang: {lang})'.format(language=self.langs_handled[lang], lang=lang))
+        return True
+
+    def parse(self, lang, text):
+        """Parses text with the interpreter for lang (loading it if need be)
+
+        Parses in the same language are done one at a time, as some pipeline
+        components (eg the CRF tagger behind ner_crf) are not thread safe"""
+        interpreter = self.get(lang)
+        with self._parse_locks[lang]:
+            return interpreter.parse(text)
+
+    def parse_batch(self, lang, texts, batch_size=256):
+        """Parses a list of texts in lang, as for parse (see parse_batch below)"""
+        interpreter = self.get(lang)
+        with self._parse_locks[lang]:
+            return parse_batch(interpreter, texts, batch_size)
+
+    def _load(self, lang):
+        self.logger.info('Loading interpreter for {language} (lang: {lang})'.format(language=self.langs_handled[lang], lang=lang))
+        rss_before = u.rss_mb()
+        version = model_version(lang)
+        interpreter = self.loader(lang)
+        rss_after = u.rss_mb()
+        if (rss_before is not None) and (rss_after is not None):
+            self.footprint_mb[lang] = max(rss_after - rss_before, 0.0)
+            self.logger.debug('Interpreter for {lang} took approx. {mb:.0f} MB'.format(lang=lang, mb=self.footprint_mb[lang]))
+        if self.metrics is not None:
+            self.metrics.count('model_load', lang)
+        return interpreter, version
+
+    def _swap_in(self, lang, interpreter, version):
+        """Makes interpreter the one used for lang, telling the listeners if it
+        is from a different model to the one previously loaded"""
+        with self._lock:
+            changed = (lang in self.versions) and (self.versions[lang] != version)
+            self.loaded[lang] = interpreter
+            self.loaded.move_to_end(lang)
+            self.versions[lang] = version
+            evicted = self._enforce_limits(keep=lang)
+        if evicted > 0:
+            # once the lock is released, so other threads are not held up meanwhile
+            gc.collect()
+        if changed:
+            for listener in self.model_change_listeners:
+                listener(lang)
+
+    def resident_mb(self):
+        """Approximate memory used by the currently loaded interpreters"""
+        with self._lock:
+            return sum(self.footprint_mb.get(lang, 0.0) for lang in self.loaded)
+
+    def _over_limits(self):
+        if (self.max_loaded > 0) and (len(self.loaded) > self.max_loaded):
+            return True
+        if (self.max_memory_mb > 0) and (self.resident_mb() > self.max_memory_mb):
+            return True
+        return False
+
+    def _enforce_limits(self, keep=None):
+        """Drops least recently used interpreters until within the limits
+        (never dropping 'keep', the one just requested). Called with the lock
+        held, so the caller collects the garbage afterwards.
+
+        Return: the number dropped"""
+        dropped = 0
+        while self._over_limits():
+            victims = [lang for lang in self.loaded if lang != keep]
+            if len(victims) == 0:
+                break
+            if self._drop(victims[0]):
+                dropped += 1
+        return dropped
+
+    def _drop(self, lang):
+        with self._lock:
+            if lang not in self.loaded:
+                return False
+            del self.loaded[lang]
+            if self.metrics is not None:
+                self.metrics.count('model_evict', lang)
+            self.logger.info('Evicted interpreter for {language} (lang: {lang})'.format(language=self.langs_handled[lang], lang=lang))
+            return True
+
+
+class ModelWatcher(object):
+    """Polls the trained models on a background thread and calls on_change(lang)
+    when the model for a language has been retrained
+
+    A new version is only acted on once it has stayed the same for a whole
+    interval, so a model still being written out is not loaded part way through."""
+
+    def __init__(self, langs, on_change, interval=10.0, logger=None):
+        self.on_change = on_change
+        self.interval = interval
+        self.logger = logger or logging.getLogger('root')
+        self.versions = {lang: model_version(lang) for lang in langs}
+        self.pending = {}   # lang -> new version seen at the last check
+        self._stop = threading.Event()
+        self._thread = None
+
+    def check(self):
+        """Return: the languages whose new model has settled since the last check"""
+        changed = []
+        for lang, known in self.versions.items():
+            version = model_version(lang)
+            if (version == known) or (version is None):
+                # unchanged, or the model directory is being replaced
+                self.pending.pop(lang, None)
+            elif self.pending.get(lang) == version:
+                del self.pending[lang]
+                self.versions[lang] = version
+                changed.append(lang)
+            else:
+                self.pending[lang] = version
+        return changed
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            for lang in self.check():
+                self.logger.info('Model for lang {lang} has been retrained'.format(lang=lang))
+                try:
+                    self.on_change(lang)
+                except Exception as e:
+                    self.logger.error('Error reloading model for lang {lang}: {e}'.format(lang=lang, e=str(e)))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='model-watcher')
+        self._thread.daemon = True
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
+
+
+def parse_batch(interpreter, texts, batch_size=256):
+    """Parses a list of texts with one interpreter, giving the same output as
+    calling interpreter.parse on each of them.
+
+    Where the pipeline starts with spaCy the texts are run through nlp.pipe
+    together (which is much faster than one at a time) and the remaining
+    components are then applied to each message."""
+    pipeline = getattr(interpreter, 'pipeline', None)
+    context = getattr(interpreter, 'context', None) or {}
+    nlp = context.get('spacy_nlp')
+    if (nlp is None) or (not pipeline) or (pipeline[0].name != 'nlp_spacy'):
+        return [interpreter.parse(text) for text in texts]
+
+    from rasa_nlu.training_data import Message
+    messages = [Message(text, interpreter.default_output_attributes()) for text in texts]
+    for message, doc in zip(messages, nlp.pipe(texts, batch_size=batch_size)):
+        message.set('spacy_doc', doc)
+    for component in pipeline[1:]:
+        for message in messages:
+            component.process(message, **context)
+
+    results = []
+    for message in messages:
+        output = interpreter.default_output_attributes()
+        output.update(message.as_dict(only_output_properties=True))
+        results.append(output)
+    return results
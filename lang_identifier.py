@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""A fast language identifier that only considers the languages the bot handles
+
+It uses the same n-gram profiles as langdetect, but only for the candidate
+languages, held as a single array of log probabilities so that scoring an
+input is one lookup and sum rather than langdetect's repeated random sampling
+over all ~55 of its profiles."""
+
+import os
+import json
+import math
+import importlib.util
+import unicodedata
+
+import numpy as np
+
+N_GRAM = 3
+# Same additive smoothing as langdetect (its ALPHA_DEFAULT / BASE_FREQ)
+SMOOTHING = 0.5 / 10000
+# Inputs with no more than this many n-grams are scored (and their scores turned
+# into probabilities) in plain Python, which is quicker than numpy for so few
+SHORT_INPUT_NGRAMS = 24
+
+
+class Language(object):
+    """A detected language and its probability (as in langdetect's results)"""
+    __slots__ = ('lang', 'prob')
+
+    def __init__(self, lang, prob):
+        self.lang = lang
+        self.prob = prob
+
+    def __repr__(self):
+        return '{lang}:{prob}'.format(lang=self.lang, prob=self.prob)
+
+
+def profiles_dir():
+    """Returns the directory holding langdetect's language profiles (without importing langdetect)"""
+    spec = importlib.util.find_spec('langdetect')
+    if spec is None:
+        raise ImportError('langdetect is needed for its language profiles')
+    return os.path.join(list(spec.submodule_search_locations)[0], 'profiles')
+
+
+class _CharNormaliser(dict):
+    """Maps characters much as langdetect's NGram.normalize does (for str.translate):
+    digits, punctuation and symbols become spaces and letters are kept"""
+
+    def __missing__(self, code):
+        ch = chr(code)
+        if ch.isalpha():
+            # normalisation for Romanian (comma below => cedilla)
+            result = {u'ș': u'ş', u'ț': u'ţ'}.get(ch, ch)
+        elif unicodedata.category(ch) == 'Mn':
+            result = ch
+        else:
+            result = ' '
+        self[code] = result
+        return result
+
+
+class LanguageIdentifier(object):
+    """Identifies which of a set of candidate languages some text is in
+
+    langs: the language codes to choose between (eg the keys of langs_handled)"""
+
+    def __init__(self, langs, logger=None):
+        self.langs = []
+        profiles = []
+        directory = profiles_dir()
+        for lang in langs:
+            path = os.path.join(directory, lang)
+            if not os.path.exists(path):
+                if logger is not None:
+                    logger.warning('No language profile for {lang} so it cannot be detected'.format(lang=lang))
+                continue
+            with open(path, encoding='utf-8') as profile_file:
+                profiles.append(json.load(profile_file))
+            self.langs.append(lang)
+
+        # One row of log probabilities (one column per language) for each n-gram
+        # seen in any of the candidate profiles
+        self.ngram_index = {}
+        for profile in profiles:
+            for ngram in profile['freq']:
+                if (0 < len(ngram) <= N_GRAM) and (ngram not in self.ngram_index):
+                    self.ngram_index[ngram] = len(self.ngram_index)
+        probs = np.zeros((len(self.ngram_index), len(self.langs)), dtype=np.float64)
+        for col, profile in enumerate(profiles):
+            n_words = profile['n_words']
+            for ngram, freq in profile['freq'].items():
+                if ngram in self.ngram_index:
+                    probs[self.ngram_index[ngram], col] = float(freq) / n_words[len(ngram) - 1]
+        self.log_probs = np.log(probs + SMOOTHING)
+        # plain Python copy of the rows for the short input path
+        self.log_prob_rows = [tuple(row) for row in self.log_probs.tolist()]
+        self.normaliser = _CharNormaliser()
+
+    def extract_ngrams(self, text):
+        """Returns the indexes of the known 1 to 3-grams in text (as langdetect does,
+        each word is padded with spaces and words in capitals are skipped)"""
+        indexes = []
+        for word in text.translate(self.normaliser).split():
+            if (len(word) > 1) and word.isupper():
+                continue
+            padded = ' ' + word + ' '
+            for end in range(2, len(padded) + 1):
+                for n in range(1, N_GRAM + 1):
+                    if end - n < 0:
+                        break
+                    ngram = padded[end - n:end]
+                    if ngram == ' ':
+                        continue
+                    idx = self.ngram_index.get(ngram)
+                    if idx is not None:
+                        indexes.append(idx)
+        return indexes
+
+    def detect(self, text):
+        """Return: the candidate languages with their probabilities, most likely
+        first (empty if nothing in the text could be used)"""
+        if len(self.langs) == 1:
+            return [Language(self.langs[0], 1.0)]
+        indexes = self.extract_ngrams(text)
+        if len(indexes) == 0:
+            return []
+
+        # Each character is in up to N_GRAM overlapping n-grams, so the summed
+        # log likelihood counts the same evidence N_GRAM times over; scaling it
+        # back keeps the probabilities from all being ~1.0 or ~0.0
+        if len(indexes) <= SHORT_INPUT_NGRAMS:
+            scores = [sum(column) / N_GRAM for column in zip(*[self.log_prob_rows[idx] for idx in indexes])]
+            top = max(scores)
+            scores = [math.exp(score - top) for score in scores]
+            total = sum(scores)
+            detected = [Language(lang, score / total) for lang, score in zip(self.langs, scores)]
+            detected.sort(key=lambda language: -language.prob)
+            return detected
+
+        scores = self.log_probs[indexes].sum(axis=0) / N_GRAM
+        scores = np.exp(scores - scores.max())
+        scores = scores / scores.sum()
+        order = np.argsort(-scores)
+        return [Language(self.langs[i], float(scores[i])) for i in order]
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""Low overhead timers and counters for the stages of handling a message
+
+Timings are kept per stage and language in rolling histograms (recent samples
+for percentiles plus cumulative buckets) and can be shown on screen or exported
+as a JSON snapshot or Prometheus text.  When disabled, start() returns None and
+stop() / count() return straight away, so instrumentation costs next to nothing."""
+
+import json
+import time
+import bisect
+import threading
+from collections import deque
+
+import util as u # some local utility functions
+
+# Upper bounds (in seconds) of the cumulative histogram buckets
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class RollingHistogram(object):
+    """Latencies for one stage: the most recent samples plus running totals"""
+
+    def __init__(self, window=1000):
+        self.recent = deque(maxlen=window)
+        self.bucket_counts = [0] * (len(BUCKETS) + 1)   # the last is for samples over every bound
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        self.recent.append(seconds)
+        self.bucket_counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def summary(self):
+        summary = u.latency_summary(list(self.recent))
+        summary['count'] = self.count
+        summary['total_s'] = self.total
+        del summary['throughput']
+        return summary
+
+
+class Metrics(object):
+    """Per stage (and per language) timings and counters
+
+    Typical use:
+        started = metrics.start()
+        ...
+        metrics.stop('parse', started, lang)"""
+
+    def __init__(self, enabled=True, window=1000):
+        self.enabled = enabled
+        self.window = window
+        self.histograms = {}    # (stage, lang) -> RollingHistogram
+        self.counters = {}      # (name, lang) -> count
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Return: a start time to pass to stop (None when disabled)"""
+        if not self.enabled:
+            return None
+        return time.perf_counter()
+
+    def stop(self, stage, started, lang=None):
+        """Records the time since started against stage (and lang)
+
+        Return: the seconds taken (None when disabled)"""
+        if started is None:
+            return None
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            histogram = self.histograms.get((stage, lang))
+            if histogram is None:
+                histogram = self.histograms[(stage, lang)] = RollingHistogram(self.window)
+            histogram.add(elapsed)
+        return elapsed
+
+    def count(self, name, lang=None, n=1):
+        """Adds n to a counter"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[(name, lang)] = self.counters.get((name, lang), 0) + n
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+            self.started = time.time()
+
+    def snapshot(self):
+        """Return: all the timings and counters as a JSON serialisable dictionary"""
+        with self._lock:
+            stages = [dict(stage=stage, lang=lang, **histogram.summary())
+                for (stage, lang), histogram in sorted(self.histograms.items(), key=lambda item: (item[0][0], item[0][1] or ''))]
+            counters = [{'name': name, 'lang': lang, 'count': count}
+                for (name, lang), count in sorted(self.counters.items(), key=lambda item: (item[0][0], item[0][1] or ''))]
+        return {'time': time.time(), 'since': self.started, 'stages': stages, 'counters': counters}
+
+    def to_prometheus(self):
+        """Return: the timings (as histograms) and counters in Prometheus text format"""
+        lines = ['# HELP mlb_stage_seconds Time spent in each stage of handling a message',
+            '# TYPE mlb_stage_seconds histogram']
+        with self._lock:
+            for (stage, lang), histogram in sorted(self.histograms.items(), key=lambda item: (item[0][0], item[0][1] or '')):
+                labels = 'stage="{stage}",lang="{lang}"'.format(stage=stage, lang=lang or '')
+                cumulative = 0
+                for bound, bucket_count in zip(BUCKETS, histogram.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append('mlb_stage_seconds_bucket{{{labels},le="{le}"}} {n}'.format(labels=labels, le=bound, n=cumulative))
+                lines.append('mlb_stage_seconds_bucket{{{labels},le="+Inf"}} {n}'.format(labels=labels, n=histogram.count))
+                lines.append('mlb_stage_seconds_sum{{{labels}}} {total}'.format(labels=labels, total=histogram.total))
+                lines.append('mlb_stage_seconds_count{{{labels}}} {n}'.format(labels=labels, n=histogram.count))
+            lines.append('# HELP mlb_events_total Counts of events when handling messages')
+            lines.append('# TYPE mlb_events_total counter')
+            for (name, lang), count in sorted(self.counters.items(), key=lambda item: (item[0][0], item[0][1] or '')):
+                lines.append('mlb_events_total{{name="{name}",lang="{lang}"}} {n}'.format(name=name, lang=lang or '', n=count))
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path):
+        """Writes a snapshot to path: JSON if it ends in .json, otherwise Prometheus text"""
+        if path.lower().endswith('.json'):
+            text = json.dumps(self.snapshot(), indent=2)
+        else:
+            text = self.to_prometheus()
+        with open(path, 'w') as export_out:
+            export_out.write(text)
+
+    def report(self):
+        """Return: lines of a table of the timings and counters, for showing on screen"""
+        snapshot = self.snapshot()
+        lines = ['{stage:<14}{lang:<6}{count:>8}{p50:>10}{p95:>10}{p99:>10}'.format(
+            stage='stage', lang='lang', count='count', p50='p50 ms', p95='p95 ms', p99='p99 ms')]
+        for s in snapshot['stages']:
+            lines.append('{stage:<14}{lang:<6}{count:>8}{p50:>10.2f}{p95:>10.2f}{p99:>10.2f}'.format(
+                stage=s['stage'], lang=s['lang'] or '-', count=s['count'], p50=s['p50_ms'], p95=s['p95_ms'], p99=s['p99_ms']))
+        if len(snapshot['counters']) > 0:
+            lines.append('  '.join('{name}{lang}: {count}'.format(name=c['name'], lang=('[' + c['lang'] + ']') if c['lang'] else '', count=c['count'])
+                for c in snapshot['counters']))
+        return lines
@@ -3,61 +3,77 @@
 from __future__ import print_function
 from builtins import input
 
+import time
+IMPORT_START = time.time() # for reporting import time and time to first prompt
+
 import sys
 import signal
 import os
-import pickle
-#import time
 import datetime
 import readline
 import logging
 from colored import fore, back, style
 import click
 
-from langdetect import detect_langs
-from langdetect import DetectorFactory
-DetectorFactory.seed = 0
-
-from rasa_nlu.model import Metadata, Interpreter
-from rasa_nlu.config import RasaNLUConfig
-
+import threading
 import configparser
+from collections import OrderedDict
 #import re
 #from string import Template
 import util as u # some local utility functions
+# NB: modules with slow imports (rasa_nlu, langdetect, numpy, asyncio and
+# multiprocessing) are only imported where first used, so the prompt shows quickly
+from interpreters import InterpreterManager, ModelWatcher, load_interpreter
+from parse_cache import ParseCache
+from user_store import PickleUserStore, SqliteUserStore, UserRecord
+from metrics import Metrics
+from channels import ScreenChannel, ReplyChannel, WebhookChannel
+from admission import AdmissionControl, DELAYED, REJECTED_RATE, REJECTED_OVERLOAD
+from interaction_log import InteractionLog, Trace, NO_TRACE
+
+IMPORT_TIME = time.time() - IMPORT_START
 
 class Core:
     """Core is the main class for MLB"""
 
-    def pickle_user_dict(self):
-        """Pickles the user dictionary to pickle file so that subsequent runs still keep the same user metrics (if available)"""
-        try:
-            pickle_out = open(self.pickle_file,'wb')
-            pickle.dump(self.user_dict, pickle_out)
-            pickle_out.close()
-        except Exception as e:
-            self.logger.warn('Problem pickling user dictionary')
-        return
-
-    def unpickle_user_dict(self):
-        """Unpickles (loads) the user dictionary from pickle file so that subsequent runs still keep the same user metrics (if available)"""
-        if os.path.exists(self.pickle_file):
-            try:
-                pickle_in = open(self.pickle_file,'rb')
-                self.user_dict = pickle.load(pickle_in)
-            except Exception as e:
-                self.logger.warn('Problem unpickling user dictionary')
-                self.user_dict = {}
-        else:
-            self.logger.info('No pickle file found (' + self.pickle_file + ') so setting user_dict to empty.')
-            self.user_dict = {}
-        return
+    def open_user_store(self):
+        """Opens the store that user stats are kept in between runs (migrating the
+        pickle file of earlier versions into the SQLite store on first use)"""
+        if self.user_store_type == 'sqlite':
+            store = SqliteUserStore(self.user_db_file, self.logger,
+                flush_every=self.user_flush_every, flush_seconds=self.user_flush_seconds)
+            store.migrate_pickle(self.pickle_file)
+            return store
+        if self.user_store_type != 'pickle':
+            self.logger.warn('Unrecognised user store ({store}). Defaulting to pickle.'.format(store=self.user_store_type))
+        return PickleUserStore(self.pickle_file, self.logger)
+
+
+    def save_user(self, user):
+        """Records the user's latest stats in the user store (and periodically
+        drops idle users from memory)"""
+        self.user_store.put(user['user_id'], user)
+        if user['user_id'] in self.user_dict:
+            self.user_dict.move_to_end(user['user_id'])
+        if time.time() - self.last_eviction > self.EVICTION_INTERVAL:
+            self.evict_idle_users()
 
 
     def before_quit(self):
         """Does any required closinng of resources prior to the programme quiting
         and then reports end of script execution"""
-        self.pickle_user_dict()
+        if getattr(self, 'model_watcher', None) is not None:
+            self.model_watcher.stop()
+        for channel in getattr(self, 'output_channels', []):
+            channel.close()
+        if getattr(self, 'interaction_log', None) is not None:
+            self.interaction_log.close()
+        if getattr(self, 'user_store', None) is not None:
+            self.user_store.close()
+        if getattr(self, 'parse_cache', None) is not None:
+            self.logger.info('Parse cache: {hits} hits, {misses} misses'.format(**self.parse_cache.stats()))
+        if getattr(self, 'parse_pool', None) is not None:
+            self.parse_pool.close()
         try:
             self.logger.warn('Ending script execution now\n')
         except (AttributeError, NameError) as e:
@@ -72,6 +88,12 @@ class Core:
         sys.exit(130)  # 130 is standard exit code for <ctrl> C
 
 
+    def handle_sighup(self, signal, frame):
+        """Checks for retrained models and swaps them in (eg after kill -HUP)"""
+        self.logger.info('Received SIGHUP: checking for retrained models')
+        self.reload_models_in_background()
+
+
     def highlight(self, text, entities, sty_start = u.STY_DESC_INV, sty_end = u.STY_DESC):
         start = 0
         output = ''
@@ -84,29 +106,56 @@ class Core:
 
     def get_user(self, user_id=None):
         if user_id not in self.user_dict:
-            new_user = {}
-            new_user['msg_output'] = ''
-
-            new_user['lang_selected'] = 'en'
-
-            new_user['last_interaction_time'] = None
-            new_user['this_interaction_time'] = None
-
-            new_user['input_counter'] = 0
-            new_user['session_counter'] = 0
-            new_user['total_sessions'] = 0
-            new_user['current_buttons'] = []
-
-            self.user_dict[user_id] = new_user
-            #self.logger.debug('get_user is returning new user ' + str(user_id))
-            return new_user
+            user = self.user_store.get(user_id)
+            if user is None:
+                user = UserRecord(user_id)
+                #self.logger.debug('get_user is returning new user ' + str(user_id))
+            self.user_dict[user_id] = user
+            return user
         #self.logger.debug('get_user is returning existing user ' + str(user_id))
+        self.user_dict.move_to_end(user_id)
         return self.user_dict[user_id]
 
 
-    def get_user_language(self):
-        """Returns the current user's language"""
-        return self.langs_handled[self.user['lang_selected']]
+    def evict_idle_users(self):
+        """Drops users who have not interacted for longer than the session time
+        limit (or at all) from memory (they are saved first and reloaded from the
+        user store if they come back). As user_dict is kept in order of use, only
+        the idle users at its front are looked at. Nothing is evicted with the
+        pickle store, which keeps every user in memory regardless.
+
+        Return: the number of users evicted"""
+        now = time.time()
+        self.last_eviction = now
+        if not self.user_store.evicting_frees_memory:
+            return 0
+        limit = self.SESSION_TIME_LIMIT * 60
+        # user_dict is in order of use, so the idle users are all at the front
+        evicted = 0
+        while len(self.user_dict) > 0:
+            user_id, user = next(iter(self.user_dict.items()))
+            if user_id == self.user_id:
+                # the screen user stays in memory
+                if len(self.user_dict) == 1:
+                    break
+                self.user_dict.move_to_end(user_id)
+                continue
+            idle = user.idle_seconds(now)
+            if (idle is not None) and (idle <= limit):
+                break
+            del self.user_dict[user_id]
+            self.user_store.put(user_id, user)
+            evicted += 1
+        if evicted > 0:
+            self.logger.debug('Evicted {count} idle users'.format(count=evicted))
+        return evicted
+
+
+    def get_user_language(self, user=None):
+        """Returns the user's language (the current user if none given)"""
+        if user is None:
+            user = self.user
+        return self.langs_handled[user['lang_selected']]
 
 
     def update_user_dict(self, user_id=None, user=None):
@@ -134,6 +183,19 @@ class Core:
                 self.user_stats = not self.user_stats
                 self.print_settings('User stats: ' + str(self.user_stats))
                 return True
+            elif ui_lower == ':m':
+                self.show_metrics = not self.show_metrics
+                if self.show_metrics:
+                    self.metrics.enabled = True
+                self.print_settings('Show_metrics: ' + {True: 'on', False: 'off'}[self.show_metrics])
+                return True
+            elif ui_lower == ':x':
+                try:
+                    self.metrics.export(self.metrics_export_file)
+                    self.print_settings('Metrics exported to ' + self.metrics_export_file)
+                except (IOError, OSError) as e:
+                    self.logger.warn('Unable to export metrics: ' + str(e))
+                return True
             elif ui_lower == ':s':
                 self.show_parse = not self.show_parse
                 self.print_settings(
@@ -144,6 +206,10 @@ class Core:
                 self.print_settings(
                     'Show_highlight: ' + {True: 'on', False: 'off'}[self.show_highlight])
                 return True
+            elif ui_lower == ':r':
+                self.print_settings('Checking for retrained models')
+                self.reload_models_in_background()
+                return True
             elif ui_lower == ':c':
                 u.clear_screen()
                 return True
@@ -173,26 +239,30 @@ class Core:
         Invisible: suppresses subsequent output (ie NUMPY forced errors
         NB: use sparingly as hides errors too!"""
         
+        if not self.CHANNELS_OUT.get('screen'):
+            return
         if invisible:
             print(u.STY_DESC + text + u.STY_INVISIBLE)
         else:
             print(u.STY_DESC + text + u.STY_USER)
 
 
-    def update_user_stats(self):
+    def update_user_stats(self, user=None):
         """Updates the user stats, such as interaction counts etc"""
-        self.user['last_interaction_time'] = self.user['this_interaction_time']
-        self.user['this_interaction_time'] = datetime.datetime.now()
-        self.user['input_counter'] += 1
-        if self.user['last_interaction_time'] is not None:
-            if (self.user['last_interaction_time'] + datetime.timedelta(minutes=self.SESSION_TIME_LIMIT)) < datetime.datetime.now():
-                self.user['session_counter'] = 0
-                self.user['total_sessions'] += 1
-        self.user['session_counter'] += 1
+        if user is None:
+            user = self.user
+        user['last_interaction_time'] = user['this_interaction_time']
+        user['this_interaction_time'] = datetime.datetime.now()
+        user['input_counter'] += 1
+        if user['last_interaction_time'] is not None:
+            if (user['last_interaction_time'] + datetime.timedelta(minutes=self.SESSION_TIME_LIMIT)) < datetime.datetime.now():
+                user['session_counter'] = 0
+                user['total_sessions'] += 1
+        user['session_counter'] += 1
 
 
     def print_user_stats(self, display=False):
-        """Outputs current user stats, such as interaction counts etc"""
+        """Outputs current (screen) user stats, such as interaction counts etc"""
 
         if display:
             print(('\n\t{l1} Input counter: {d1}{input_counter}\t{l1} Session counter: {d1}{session_counter}\t{l1} Total sessions: {d1}{total_sessions}' + \
@@ -201,120 +271,153 @@ class Core:
                 '\t{l1} This interaction time: {d1}{this_interaction_time}\n{e}').format(**self.user, d1=u.STY_STAT_DATA,l1=u.STY_STAT_LABEL,e=u.STY_USER))
 
 
-    def pick(self, pick_list):
+    def print_metrics(self, display=False):
+        """Outputs the per stage timings and counters so far"""
+
+        if display:
+            self.print_settings('\n\t' + '\n\t'.join(self.metrics.report()) + '\n')
+
+
+    def pick(self, pick_list, user=None):
+        if user is None:
+            user = self.user
         if type(pick_list) == list:
             if len(pick_list) > 0:
-                return pick_list[self.user['session_counter'] % len(pick_list)]
+                return pick_list[user['session_counter'] % len(pick_list)]
             else:
                 return ''
         else:
             return ''
 
 
-    def button_selection(self, button_choice=None, show_parse=False):
+    def button_selection(self, button_choice=None, show_parse=False, user=None):
         """Displays then returns the user selection as if they had typed it in 
         rather than selected it via a button"""
 
+        if user is None:
+            user = self.user
         prompt_text = '>'
         if button_choice is not None:
             button_choice = button_choice.replace(':','')
             self.logger.debug('User selected a button (' + button_choice + ')')
             int_button_choice = int(button_choice) - 1
-            if (int_button_choice in range(len(self.user['current_buttons']))):
-                chosen_input = self.user['current_buttons'][int_button_choice]
+            if (int_button_choice in range(len(user['current_buttons']))):
+                chosen_input = user['current_buttons'][int_button_choice]
             else:
                 chosen_input = ''
                 self.print_settings('Invalid choice')
             chosen_input = chosen_input + '\n'
-            self.say_text(prompt_text + chosen_input)
-            self.check_input(chosen_input, show_parse)
+            self.say_text(prompt_text + chosen_input, user=user)
+            self.check_input(chosen_input, show_parse, user=user)
             return chosen_input
         else:
             return ''
 
-    def say_text(self, text, buttons=None, out=sys.stdout):
-        """Handles 'saying' the output, with different approaches depending on the
-        active channel (or channels) for output"""
+    def say_text(self, text, buttons=None, out=None, user=None):
+        """Handles 'saying' the output, passing it to each of the active output
+        channels (see channels.py), which each render it in their own way.
+        A text starting with '>' is an echo of the user's input (eg a button
+        choice) and only shown on screen.
+
+        out: where screen output goes, in place of self.out (useful for unit tests)"""
 
-        # Useful for unit tests
-        sys.stdout = out
         BUTTON_LIMIT = 3
+        started = self.metrics.start()
+        if user is None:
+            user = self.user
 
         # do this same manner for both output routes
-        self.user['current_buttons'] = []
+        user['current_buttons'] = []
         if ((isinstance(buttons, list)) and (len(buttons) > 0)):
             if len(buttons) > BUTTON_LIMIT:
                 self.logger.warn('No more than ' + str(BUTTON_LIMIT) +' buttons can be displayed (content may be missing)')
             # just allow first N buttons
-            self.user['current_buttons'] = buttons[:BUTTON_LIMIT]
-            self.logger.debug('User button choices: ' + str(self.user['current_buttons']))
+            user['current_buttons'] = buttons[:BUTTON_LIMIT]
+            self.logger.debug('User button choices: ' + str(user['current_buttons']))
 
-        if self.CHANNELS_OUT['screen']:
-            if (len(text) > 0) and (text[0] == '>'):
-                print('\n\t\t' + u.STY_CURSOR + ' > ' + u.STY_USER + text[1:] + style.RESET)
-            else:
-                print('\n\t' + u.STY_RECIPIENT + '  User: ' + str(self.user_id) + '  ' + u.STY_USER + '\t' + u.STY_RESP + '  ' + text,
-                    end='  ' + u.STY_USER + '\n\n')
-            if ((isinstance(buttons, list)) and (len(buttons) > 0)):
-                # just allow first N buttons
-                print('\t\t',end='')
-                for idx, button in zip(range(BUTTON_LIMIT), buttons):
-                    print('\t[' + str(idx + 1) + '] ' + button, end='')
-                print('\n')
+        echo = (len(text) > 0) and (text[0] == '>')
+        if echo:
+            text = text[1:]
+        out = self.out if out is None else out
+        for channel in self.output_channels:
+            channel.send(user, text, user['current_buttons'], echo, out)
+        self.metrics.stop('say', started)
 
 
-    def handle_history(self, resp):
+    def handle_history(self, resp, user=None):
         """Handles History"""
-        self.say_text('Handling History (in {language})'.format(language=self.get_user_language()))
+        self.say_text('Handling History (in {language})'.format(language=self.get_user_language(user)), user=user)
 
 
-    def handle_physics(self, resp):
+    def handle_physics(self, resp, user=None):
         """Handles Physics"""
-        self.say_text('Handling Physics (in {language})'.format(language=self.get_user_language()))
+        self.say_text('Handling Physics (in {language})'.format(language=self.get_user_language(user)), user=user)
 
 
-    def handle_biology(self, resp):
+    def handle_biology(self, resp, user=None):
         """Handles Biology"""
-        self.say_text('Handling Biology (in {language})'.format(language=self.get_user_language()))
+        self.say_text('Handling Biology (in {language})'.format(language=self.get_user_language(user)), user=user)
 
 
-    def handle_computing(self, resp):
+    def handle_computing(self, resp, user=None):
         """Handles Computing"""
-        self.say_text('Handling Computing (in {language})'.format(language=self.get_user_language()))
+        self.say_text('Handling Computing (in {language})'.format(language=self.get_user_language(user)), user=user)
 
 
-    def handle_low_confident(self):
+    def handle_low_confident(self, user=None):
         """Simple output indicating low confidence with the user input parsing"""
         low_confidence_list = [
         'Sorry, I am confused - it may be me, rather than you! :-(\nMaybe try stating your question in different words? (or even try another question?)',
         'Sorry, I\'m still learning and I don\'t think I understood you. :-(\nHow about repeating your question in different words? (or maybe try another question?)'
         ]
-        self.say_text(self.pick(low_confidence_list))
+        self.say_text(self.pick(low_confidence_list, user), user=user)
 
 
-    def handle_suitable_answer(self):
+    def handle_suitable_answer(self, user=None):
         """Simple output indicating cannot find suitable answer for user input"""
         suitable_answer_list = [
             'Sorry, I\'m having trouble coming up with a suitable answer.\nMaybe try stating your question in different words? (or even try another question?)',
             'I\'m not sure I follow your meaning.\nCould you try stating your question in different words? (or even try another question?)',
                     ]
-        self.say_text(self.pick(suitable_answer_list))
+        self.say_text(self.pick(suitable_answer_list, user), user=user)
+
+
+    def handle_warming_up(self, user=None):
+        """Simple output for input that arrives before its language model is ready"""
+        warming_up_list = [
+            'Sorry, I\'m still warming up for that language. :-)\nPlease try again in a moment.',
+            'Give me a moment please, I\'m still getting ready for that language!\nPlease try again shortly.'
+            ]
+        self.say_text(self.pick(warming_up_list, user), user=user)
+
 
+    def handle_overloaded(self, user=None):
+        """Simple output for input turned away by admission control (too busy, or the user is sending too fast)"""
+        overloaded_list = [
+            'Sorry, I\'m rather busy right now. :-(\nPlease try again in a moment.',
+            'Sorry, that\'s a bit too fast for me!\nPlease give me a moment and try again.'
+            ]
+        self.say_text(self.pick(overloaded_list, user), user=user)
 
-    def handle_empty_input(self):
+
+    def handle_empty_input(self, user=None):
         """Simple output for empty input"""
         empty_response_list = ['I\'m unsure what to say to that! :/', 'I didn\'t quite catch that! :/', 'Excuse me? :/']
         self.logger.debug('Skipping empty input')
-        self.say_text(self.pick(empty_response_list))
+        self.say_text(self.pick(empty_response_list, user), user=user)
+
 
+    def __init__(self, channels_out, channel_in = 'screen', loglvl = '', config_override = '', interpreter_loader = None):
+        """Initialises the core functionality and sets up various variables.
 
-    def __init__(self, channels_out, channel_in = 'screen', loglvl = '', config_override = ''):
-        """Initialises the core functionality and sets up various variables."""
+        interpreter_loader: optional function(lang) returning an interpreter, used
+            in place of loading the trained models (eg a stub for benchmarks)"""
 
         # TODO: add checks to confirm all necessary files are present and readable
         # (and writable if applicable)
 
         signal.signal(signal.SIGINT, self.handle_ctrl_c)
+        self.out = sys.stdout # where screen output goes
 
         self.logger = u.setup_custom_logger('root')
 
@@ -334,7 +437,7 @@ class Core:
         
         self.logger.info('Initialisation started')
 
-        channel_in_accepted = ['screen']
+        channel_in_accepted = ['screen', 'http']
         if channel_in not in channel_in_accepted:
             self.logger.error('Unrecognised channel input value. Must be one of: ' + ', '.join(channel_in_accepted) + '.')
             self.before_quit()
@@ -369,12 +472,85 @@ class Core:
             # file items
             self.history_file = os.path.abspath(config.get('files', 'history_file'))
             self.pickle_file = os.path.abspath(config.get('files', 'pickle_file'))
+            # user store items
+            self.user_store_type = config.get('users', 'store', fallback='pickle').strip().lower()
+            self.user_db_file = os.path.abspath(config.get('users', 'db_file', fallback='./data/users.sqlite'))
+            self.user_flush_every = config.getint('users', 'flush_every', fallback=50)
+            self.user_flush_seconds = config.getfloat('users', 'flush_seconds', fallback=5.0)
+            # model items
+            self.max_loaded_models = config.getint('models', 'max_loaded', fallback=0)
+            self.max_models_memory = config.getint('models', 'max_memory_mb', fallback=0)
+            self.model_watch_seconds = config.getfloat('models', 'watch_seconds', fallback=0)
+            # http channel items
+            self.http_host = config.get('http', 'host', fallback='127.0.0.1')
+            self.http_port = config.getint('http', 'port', fallback=8080)
+            self.http_workers = config.getint('http', 'workers', fallback=4)
+            # output channel items
+            self.webhook_url = config.get('channels', 'webhook_url', fallback='').strip()
+            self.webhook_queue = config.getint('channels', 'webhook_queue', fallback=1000)
+            # metrics items
+            self.metrics_enabled = config.getboolean('metrics', 'enabled', fallback=False)
+            self.metrics_window = config.getint('metrics', 'window', fallback=1000)
+            self.metrics_export_file = os.path.abspath(config.get('metrics', 'export_file', fallback='./data/mlb_metrics.prom'))
+            # language detection items
+            self.detection_engine = config.get('detection', 'engine', fallback='langdetect').strip().lower()
+            self.speculative_margin = config.getfloat('detection', 'speculative_margin', fallback=0.0)
+            self.speculative_top_k = config.getint('detection', 'speculative_top_k', fallback=2)
+            self.sticky_max_words = config.getint('detection', 'sticky_max_words', fallback=0)
+            self.sticky_min_confidence = config.getfloat('detection', 'sticky_min_confidence', fallback=0.3)
+            # startup items
+            self.warm_up = config.getboolean('startup', 'warm_up', fallback=False)
+            self.not_ready = config.get('startup', 'not_ready', fallback='wait').strip().lower()
+            # parse cache items
+            self.cache_size = config.getint('cache', 'size', fallback=0)
+            self.cache_ttl = config.getint('cache', 'ttl_seconds', fallback=0)
+            # admission control items
+            self.admission_user_rate = config.getfloat('admission', 'user_rate', fallback=0.0)
+            self.admission_user_burst = config.getint('admission', 'user_burst', fallback=5)
+            self.admission_max_in_flight = config.getint('admission', 'max_in_flight', fallback=0)
+            self.admission_max_queue = config.getint('admission', 'max_queue', fallback=0)
+            self.admission_max_delay = config.getint('admission', 'max_delay_ms', fallback=500) / 1000.0
+            # interaction log items
+            self.interaction_log_enabled = config.getboolean('interaction_log', 'enabled', fallback=False)
+            self.interaction_log_file = os.path.abspath(config.get('interaction_log', 'file', fallback='./logs/mlb_interactions.jsonl'))
+            self.interaction_log_max_bytes = config.getint('interaction_log', 'max_mb', fallback=50) * 1024 * 1024
+            self.interaction_log_backups = config.getint('interaction_log', 'backups', fallback=5)
+            self.interaction_log_batch = config.getint('interaction_log', 'batch_size', fallback=100)
+            self.interaction_log_flush_seconds = config.getfloat('interaction_log', 'flush_seconds', fallback=1.0)
+            self.interaction_log_queue = config.getint('interaction_log', 'queue_size', fallback=10000)
         except configparser.Error as e:
             self.logger.error('Error reading configuration ' + str(e))
             self.before_quit()
 
-        self.unpickle_user_dict()
+        self.metrics = Metrics(self.metrics_enabled, self.metrics_window)
+
+        # Replies go to each of the active output channels
+        self.output_channels = []
+        if self.CHANNELS_OUT.get('screen'):
+            self.output_channels.append(ScreenChannel())
+        if self.CHANNELS_OUT.get('http'):
+            # collected per user and returned as the reply to the request
+            self.output_channels.append(ReplyChannel())
+        if self.webhook_url != '':
+            self.CHANNELS_OUT['webhook'] = True
+            self.output_channels.append(WebhookChannel(self.webhook_url, self.logger, self.metrics, self.webhook_queue))
+
+        # Every input handled is recorded (as JSON lines) by a background writer
+        if self.interaction_log_enabled:
+            self.interaction_log = InteractionLog(self.interaction_log_file, self.logger,
+                max_bytes=self.interaction_log_max_bytes, backups=self.interaction_log_backups,
+                batch_size=self.interaction_log_batch, flush_seconds=self.interaction_log_flush_seconds,
+                max_queue=self.interaction_log_queue)
+        else:
+            self.interaction_log = None
+
+        # users are loaded from the store as they are first seen
+        self.user_store = self.open_user_store()
+        self.user_dict = OrderedDict() # user_id -> UserRecord, least recently used first
+        self.EVICTION_INTERVAL = 60 # Time in seconds between checks for idle users to drop from memory
+        self.last_eviction = time.time()
         self.SESSION_TIME_LIMIT = 10 # Time in minutes to consider a subsequent interaction to be from a new session
+        # the screen user (other channels look up their users per request)
         self.user_id = '1234'
         self.user = self.get_user(self.user_id)
 
@@ -384,87 +560,458 @@ class Core:
         self.show_highlight = False
         self.show_parse = False
         self.user_stats = False
-        self.show_language = True
+        self.show_language = (self.CHANNEL_IN == 'screen')
+        self.show_metrics = False
 
         #self.langs_handled = {'en':'English'}
         #self.langs_handled = {'fr':'French'}
         self.langs_handled = {'en':'English', 'fr':'French'}
         #self.langs_handled = {'en':'English', 'fr':'French', 'de':'German'}
 
-        self.lang_interpreters = {}
-
-        # This is a more generic equivalent of:
+        # Interpreters are loaded lazily, the first time input is routed to their
+        # language (rather than the equivalent of this for every language up front):
         #   self.interpreter_de = Interpreter.load('projects/default/current_de', RasaNLUConfig('config/mlb_config_de.json'))
+        self.lang_interpreters = InterpreterManager(self.langs_handled,
+            max_loaded=self.max_loaded_models, max_memory_mb=self.max_models_memory,
+            loader=interpreter_loader or load_interpreter, logger=self.logger, metrics=self.metrics)
 
         for lang in self.langs_handled:
-            try:
-                self.logger.info('Configuring interpreter for {language}'.format(language=self.langs_handled[lang]))
-                self.lang_interpreters[lang] = Interpreter.load('projects/default/current_{lang}'.format(lang=lang), RasaNLUConfig('config/mlb_config_{lang}.json'.format(lang=lang)))
-            except:
-                self.logger.error('Error with creating interpreter for {language} (lang: {lang})'.format(language=self.langs_handled[lang], lang=lang))
+            if (interpreter_loader is None) and (not self.lang_interpreters.model_exists(lang)):
+                self.logger.error('No trained model found for {language} (lang: {lang})'.format(language=self.langs_handled[lang], lang=lang))
                 self.logger.info('Maybe you need to train the model? Try equivalent of: python -m rasa_nlu.train -c config/mlb_config_XX.json')
                 self.before_quit()
 
+        # The fast engine only considers the languages handled; langdetect scores all it knows
+        # (either is set up on first use, see get_lang_identifier)
+        if self.detection_engine not in ('fast', 'langdetect'):
+            self.logger.warn('Unrecognised detection engine ({engine}). Defaulting to langdetect.'.format(engine=self.detection_engine))
+            self.detection_engine = 'langdetect'
+        self.lang_identifier = None
+        self.lang_identifier_lock = threading.Lock()
+        # Threads for parsing in several languages at once, when detection is unsure (see parse_speculatively)
+        self.speculative_executor = None
+
+        # Repeated inputs are answered from the cache, skipping detection and parsing
+        if self.cache_size > 0:
+            self.parse_cache = ParseCache(self.cache_size, self.cache_ttl)
+            self.lang_interpreters.model_change_listeners.append(self.parse_cache.invalidate)
+        else:
+            self.parse_cache = None
+
+        # Messages can be limited per user and overall, with the excess given a canned reply
+        if (self.admission_user_rate > 0) or (self.admission_max_in_flight > 0):
+            self.admission = AdmissionControl(self.admission_user_rate, self.admission_user_burst,
+                self.admission_max_in_flight, self.admission_max_queue, self.admission_max_delay)
+        else:
+            self.admission = None
+
+        # Languages can optionally be parsed in their own pools of worker processes
+        workers_per_lang = {lang: config.getint('workers', lang, fallback=0) for lang in self.langs_handled}
+        if sum(workers_per_lang.values()) > 0:
+            from workers import WorkerPool
+            self.parse_pool = WorkerPool(self.langs_handled, workers_per_lang, self.logger)
+        else:
+            self.parse_pool = None
+
         self.last_input = {}
 
         self.print_user_stats(self.user_stats)
 
+        if self.warm_up:
+            self.start_warm_up()
+
+        # Retrained models are swapped in without a restart, either when spotted
+        # by the watcher or on request (SIGHUP or :r)
+        self.reload_lock = threading.Lock()
+        if self.model_watch_seconds > 0:
+            self.model_watcher = ModelWatcher(list(self.langs_handled), lambda lang: self.reload_models([lang]),
+                interval=self.model_watch_seconds, logger=self.logger)
+            self.model_watcher.start()
+        else:
+            self.model_watcher = None
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self.handle_sighup)
+
+        self.logger.debug('Imports took {secs:.3f}s'.format(secs=IMPORT_TIME))
         self.logger.info('Initialisation complete')
 
 
-    def check_input(self, u_input, show_parse=False):
-        """Checks the user supplied input and passes it to the Rasa NLU model to
-        get the intent and entities"""
+    def start_warm_up(self):
+        """Loads the interpreters (and language identifier) on a background thread,
+        running a dummy parse through each so the first real message is not slow.
+        Languages with worker processes are left to the workers, which load
+        their own interpreters."""
+        langs = [lang for lang in self.langs_handled
+            if (self.parse_pool is None) or (lang not in self.parse_pool)]
+        if self.max_loaded_models > 0:
+            langs = langs[:self.max_loaded_models]
+        self.lang_interpreters.warm_up(langs, before=self.get_lang_identifier)
+
+
+    def reload_models(self, langs=None, force=False):
+        """Swaps in the retrained models for langs (all languages if none given),
+        one language at a time. Each old interpreter (or set of workers) carries
+        on serving until its replacement has loaded, so other languages and the
+        language being reloaded are not held up.
+
+        force: reload even if the model has not changed
+
+        Return: the languages reloaded"""
+        reloaded = []
+        with self.reload_lock:
+            for lang in (self.langs_handled if langs is None else langs):
+                try:
+                    if (self.parse_pool is not None) and (lang in self.parse_pool):
+                        done = self.parse_pool.restart(lang, force)
+                        if done and (self.parse_cache is not None):
+                            self.parse_cache.invalidate(lang)
+                    else:
+                        # the parse cache is invalidated by the interpreter manager
+                        done = self.lang_interpreters.reload(lang, force)
+                except Exception as e:
+                    self.logger.error('Error reloading model for {language} (lang: {lang}): {e}'.format(language=self.langs_handled[lang], lang=lang, e=str(e)))
+                    continue
+                if done:
+                    self.metrics.count('model_reload', lang)
+                    reloaded.append(lang)
+        if len(reloaded) == 0:
+            self.logger.info('No retrained models to reload')
+        return reloaded
+
+
+    def reload_models_in_background(self, langs=None):
+        """Runs reload_models on a separate thread (so input is still handled meanwhile)
+
+        Return: the thread"""
+        thread = threading.Thread(target=self.reload_models, args=(langs,), name='model-reload')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+    def get_lang_identifier(self):
+        """Returns the function used to detect languages, setting it up on first use"""
+        with self.lang_identifier_lock:
+            if self.lang_identifier is None:
+                started = time.time()
+                if self.detection_engine == 'fast':
+                    from lang_identifier import LanguageIdentifier
+                    self.lang_identifier = LanguageIdentifier(list(self.langs_handled), self.logger).detect
+                else:
+                    from langdetect import detect_langs, DetectorFactory
+                    DetectorFactory.seed = 0
+                    self.lang_identifier = detect_langs
+                self.logger.debug('Set up {engine} language detection in {secs:.3f}s'.format(engine=self.detection_engine, secs=time.time() - started))
+            return self.lang_identifier
+
+
+    def detect_language(self, u_input):
+        """Detects the language of the (cleaned) input
+
+        Return: the languages detected and the first of those that is handled
+        (defaulting to English, or the first language handled if not English,
+        if none are)"""
+        detect = self.lang_identifier or self.get_lang_identifier()
+        try:
+            langs_det = detect(u_input)
+        except Exception as e:
+            # eg langdetect given input with no letters in it, such as '42'
+            self.logger.debug('Language detection failed: ' + str(e))
+            langs_det = []
+
+        lang_selected = 'en' if 'en' in self.lang_interpreters else next(iter(self.langs_handled))
+        for l in langs_det:
+            if l.lang in self.lang_interpreters:
+                lang_selected = l.lang
+                break
+        return langs_det, lang_selected
+
+
+    def speculative_langs(self, langs_det):
+        """Returns the handled languages that are close enough to the most likely
+        one (within speculative_margin of its probability) to be worth parsing
+        as well, most likely first and at most speculative_top_k of them (just
+        the first if speculative parsing is off).
+
+        Only languages with parse workers are considered, as interpreters in
+        this process hold the GIL for most of a parse, so parsing in several of
+        them at once would take about as long as one after the other."""
+        handled = [l for l in langs_det if l.lang in self.lang_interpreters]
+        if (self.speculative_margin <= 0) or (len(handled) < 2) or (self.parse_pool is None) or (handled[0].lang not in self.parse_pool):
+            return [l.lang for l in handled[:1]]
+        return [l.lang for l in handled[:self.speculative_top_k]
+            if (handled[0].prob - l.prob <= self.speculative_margin) and (l.lang in self.parse_pool)]
+
+
+    def parse_speculatively(self, langs, u_input):
+        """Parses the (cleaned) input in each of langs at the same time and keeps
+        the parse with the most confident intent
+
+        Return: the language chosen and its parse response"""
+        if self.speculative_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self.speculative_executor = ThreadPoolExecutor(max_workers=max(2, self.speculative_top_k))
+        futures = [(lang, self.speculative_executor.submit(self.parse_text, lang, u_input)) for lang in langs]
+        best_lang, best_resp, best_confidence, error = None, None, -1.0, None
+        for lang, future in futures:
+            try:
+                resp = future.result()
+            except Exception as e:
+                error = e
+                continue
+            confidence = (resp.get('intent') or {}).get('confidence') or 0.0
+            if confidence > best_confidence:
+                best_lang, best_resp, best_confidence = lang, resp, confidence
+        if best_resp is None:
+            raise error
+        self.logger.debug('Parsed speculatively in {langs}, most confident in {lang}'.format(langs=', '.join(langs), lang=best_lang))
+        self.metrics.count('speculative_parse', langs[0])
+        if best_lang != langs[0]:
+            self.metrics.count('speculative_switch', best_lang)
+        return best_lang, best_resp
+
+
+    def sticky_language(self, u_input, user):
+        """Returns the user's language if the (cleaned) input is short enough to
+        keep to it without detection, ie the language was confirmed by a
+        confident parse earlier in this session, otherwise None"""
+        if (self.sticky_max_words <= 0) or (user['lang_session'] is None):
+            return None
+        if (user['lang_session'] != user['total_sessions']) or (user['lang_selected'] not in self.lang_interpreters):
+            return None
+        if len(u_input.split()) > self.sticky_max_words:
+            return None
+        return user['lang_selected']
+
+
+    def confident(self, resp):
+        """Checks a parse is confident enough to confirm (or keep to) a user's language"""
+        return ((resp.get('intent') or {}).get('confidence') or 0.0) >= self.sticky_min_confidence
+
+
+    def parse_text(self, lang, u_input):
+        """Parses the (cleaned) input with the interpreter for lang, in one of the
+        worker processes for that language if it has any"""
+        if (self.parse_pool is not None) and (lang in self.parse_pool):
+            return self.parse_pool.parse(lang, u_input)
+        return self.lang_interpreters.parse(lang, u_input)
+
+
+    def parse_batch(self, lang, texts, batch_size=256):
+        """Parses a list of (cleaned) inputs in lang, as for parse_text"""
+        if (self.parse_pool is not None) and (lang in self.parse_pool):
+            return self.parse_pool.parse_batch(lang, texts)
+        return self.lang_interpreters.parse_batch(lang, texts, batch_size)
+
+
+    def parse_input(self, u_input, user=None, decision=None):
+        """Checks the user supplied input and passes it to the Rasa NLU model for
+        its language to get the intent and entities.
+
+        This is the slow part of handling input and it says nothing to the user,
+        so it can be run away from the main thread (see respond for the rest)
+
+        decision: the admission control decision, if the caller has already
+            made it (in which case the caller also releases its place), otherwise
+            admission control is applied here
+
+        Return: the parse response, None for empty input, {} if the input
+        could not be parsed or a response flagged 'overloaded' if admission
+        control turned it away"""
+
+        if user is None:
+            user = self.user
+        if self.interaction_log is None:
+            return self.parse_traced(u_input, user, NO_TRACE, decision)
+        trace = Trace()
+        resp = self.parse_traced(u_input, user, trace, decision)
+        self.interaction_log.log(trace.record(user, resp))
+        return resp
+
+
+    def parse_traced(self, u_input, user, trace, decision=None):
+        """parse_input, noting what happens to the input in trace (for the interaction log)"""
 
         self.logger.debug('User input:  ' + u_input)
+        started = self.metrics.start()
         u_input = u.clean_input(u_input)
+        trace.mark('clean', self.metrics.stop('clean', started))
+        trace.set(input=u_input)
         self.logger.debug('Clean input: ' + u_input)
         if len(u_input) == 0:
-            self.handle_empty_input()
-            return
-        
-        langs_det = detect_langs(u_input)
+            self.metrics.count('empty_input')
+            trace.set(outcome='empty')
+            return None
+
+        if (self.admission is None) and (decision is None):
+            return self.parse_clean_input(u_input, user, trace)
+        admitted_here = decision is None
+        if admitted_here:
+            started = self.metrics.start()
+            decision = self.admission.admit(user['user_id'])
+            trace.mark('admission', self.metrics.stop('admission', started))
+        if decision in (REJECTED_RATE, REJECTED_OVERLOAD):
+            self.logger.debug('Turned away input from user {user_id} ({decision})'.format(user_id=user['user_id'], decision=decision))
+            self.metrics.count(decision)
+            trace.set(outcome=decision)
+            return {'text': u_input, 'overloaded': True}
+        if decision == DELAYED:
+            self.metrics.count('delayed')
+        if not admitted_here:
+            return self.parse_clean_input(u_input, user, trace)
+        try:
+            return self.parse_clean_input(u_input, user, trace)
+        finally:
+            self.admission.release()
+
+
+    def parse_clean_input(self, u_input, user, trace=NO_TRACE):
+        """Finds the language of the (cleaned, non-empty) input and parses it, for parse_input
+
+        Return: the parse response, or {} if the input could not be parsed"""
+
+        # short follow ups keep to the language already established in the session
+        previous_lang = user['lang_selected']
+        sticky_lang = self.sticky_language(u_input, user)
+        cached = None
+        if self.parse_cache is not None:
+            started = self.metrics.start()
+            cached = self.parse_cache.get(u_input, sticky_lang)
+            trace.mark('cache', self.metrics.stop('cache', started))
+        if cached is not None:
+            lang_selected, langs_det, resp = cached
+            self.metrics.count('cache_hit', lang_selected)
+            trace.set(route='cache', langs=[[l.lang, l.prob] for l in langs_det])
+            user['lang_selected'] = lang_selected
+            if self.show_language:
+                self.print_settings('\tLanguages detected: ' + str(langs_det) + ' (cached)')
+            return resp
+        # read before parsing, so a result from a model reloaded meanwhile is not cached
+        generation = self.parse_cache.generation() if self.parse_cache is not None else None
+
+        sticky_resp = None
+        if (sticky_lang is not None) and self.lang_interpreters.is_ready(sticky_lang):
+            self.metrics.count('detect_skipped', sticky_lang)
+            if self.show_language:
+                self.print_settings('\tKeeping to {language} (detection skipped)'.format(language=self.get_user_language(user)), invisible=True)
+            started = self.metrics.start()
+            try:
+                sticky_resp = self.parse_text(sticky_lang, u_input)
+            except Exception as e:
+                self.logger.error('Error with interpreter for {language} (lang: {lang}): {e}'.format(language=self.get_user_language(user), lang=sticky_lang, e=str(e)))
+                self.metrics.count('parse_error', sticky_lang)
+                trace.set(route='sticky', outcome='parse_error')
+                return {}
+            trace.mark('sticky_parse', self.metrics.stop('parse', started, sticky_lang))
+            if self.confident(sticky_resp):
+                trace.set(route='sticky')
+                if self.parse_cache is not None:
+                    self.parse_cache.put(sticky_lang, u_input, [], sticky_resp, detected=False, generation=generation)
+                return sticky_resp
+            # not confident in the user's language, so check it after all
+            self.metrics.count('sticky_redetect', sticky_lang)
+
+        started = self.metrics.start()
+        langs_det, lang_selected = self.detect_language(u_input)
+        trace.mark('detect', self.metrics.stop('detect', started, lang_selected))
+        trace.set(route='detected', langs=[[l.lang, l.prob] for l in langs_det])
         if self.show_language:
             self.print_settings('\tLanguages detected: ' + str(langs_det))
 
-        
-        lang_selected = 'en'
-        for l in langs_det:
-            if l.lang in self.lang_interpreters:
-                lang_selected = l.lang
-                break
-
-        self.user['lang_selected'] = lang_selected
+        user['lang_selected'] = lang_selected
         if self.show_language:
-            self.print_settings('\tProcessing as {language}'.format(language=self.get_user_language()), invisible=True)
+            self.print_settings('\tProcessing as {language}'.format(language=self.get_user_language(user)), invisible=True)
         else:
             self.print_settings('', invisible=True)
         # using invisible=True above as NUMPY currnetly causes this to spit out a pointless deprecation warning
-        resp = self.lang_interpreters[lang_selected].parse(u_input)
+        if (self.not_ready == 'reply') and (not self.lang_interpreters.is_ready(lang_selected)):
+            self.metrics.count('warming_up', lang_selected)
+            trace.set(outcome='warming_up')
+            return {'text': u_input, 'warming_up': True}
+        # where detection is unsure between languages, parse in each of the close ones
+        langs = [lang for lang in self.speculative_langs(langs_det) if self.lang_interpreters.is_ready(lang)]
+        started = self.metrics.start()
+        try:
+            if (sticky_resp is not None) and (langs == [sticky_lang]):
+                # already parsed in this language above
+                resp = sticky_resp
+            elif (len(langs) > 1) and (langs[0] == lang_selected):
+                lang_selected, resp = self.parse_speculatively(langs, u_input)
+                user['lang_selected'] = lang_selected
+                trace.set(route='speculative', candidates=langs)
+                if self.show_language:
+                    self.print_settings('\tMost confident as {language}'.format(language=self.get_user_language(user)), invisible=True)
+            else:
+                resp = self.parse_text(lang_selected, u_input)
+        except Exception as e:
+            self.logger.error('Error with interpreter for {language} (lang: {lang}): {e}'.format(language=self.get_user_language(user), lang=lang_selected, e=str(e)))
+            self.metrics.count('parse_error', lang_selected)
+            trace.set(outcome='parse_error')
+            return {}
+        trace.mark('parse', self.metrics.stop('parse', started, lang_selected))
+        if self.parse_cache is not None:
+            self.parse_cache.put(lang_selected, u_input, langs_det, resp, generation=generation)
+        if self.confident(resp):
+            user['lang_session'] = user['total_sessions']
+        elif lang_selected != previous_lang:
+            # the language changed without a confident parse to confirm it
+            user['lang_session'] = None
+        return resp
+
+
+    def respond(self, resp, show_parse=False, user=None):
+        """Responds to the user based on the response from parse_input"""
+
+        started = self.metrics.start()
+        try:
+            if resp is None:
+                self.handle_empty_input(user)
+                return
+            if resp.get('warming_up'):
+                self.handle_warming_up(user)
+                return
+            if resp.get('overloaded'):
+                self.handle_overloaded(user)
+                return
+            if show_parse:
+                self.print_settings('\tParse output:\n\t\t' + str(resp))
+            if self.show_highlight and ('intent' in resp):
+                self.print_settings('\n\t ' + u.STY_STAT_LABEL + resp['intent']['name'] + '\t' + u.STY_DESC + self.highlight(resp['text'], resp['entities']))
+            self.last_input = resp
+            if 'intent' in resp:
+
+                if resp['intent']['confidence'] < 0.15:
+                    self.handle_low_confident(user)
+                    return
+
+                if resp['intent']['name'] == u'history':
+                    self.handle_history(resp, user)
+                elif resp['intent']['name'] == u'physics':
+                    self.handle_physics(resp, user)
+                elif resp['intent']['name'] == u'biology':
+                    self.handle_biology(resp, user)
+                elif resp['intent']['name'] == u'computing':
+                    self.handle_computing(resp, user)
+                else:
+                    self.handle_suitable_answer(user)
+            else:
+                self.logger.info('Intent not found in response')
+                self.handle_suitable_answer(user)
+        finally:
+            self.metrics.stop('respond', started, (self.user if user is None else user)['lang_selected'])
 
-        if show_parse:
-            self.print_settings('\tParse output:\n\t\t' + str(resp))
-        if self.show_highlight:
-            self.print_settings('\n\t ' + u.STY_STAT_LABEL + resp['intent']['name'] + '\t' + u.STY_DESC + self.highlight(resp['text'], resp['entities']))
-        self.last_input = resp
-        if 'intent' in resp:
 
-            if resp['intent']['confidence'] < 0.15:
-                self.handle_low_confident()
-                return
+    def check_input(self, u_input, show_parse=False, user=None):
+        """Checks the user supplied input and passes it to the Rasa NLU model to
+        get the intent and entities, then responds to the user (the current user
+        if none given)"""
 
-            if resp['intent']['name'] == u'history':
-                self.handle_history(resp)
-            elif resp['intent']['name'] == u'physics':
-                self.handle_physics(resp)
-            elif resp['intent']['name'] == u'biology':
-                self.handle_biology(resp)
-            elif resp['intent']['name'] == u'computing':
-                self.handle_computing(resp)
-            else:
-                self.handle_suitable_answer()
-        else:
-            self.logger.info('Intent not found in response')
+        started = self.metrics.start()
+        if user is None:
+            user = self.user
+        self.respond(self.parse_input(u_input, user), show_parse, user)
+        self.save_user(user)
+        self.metrics.stop('check_input', started, user['lang_selected'])
 
 
     def main_loop(self):
@@ -473,10 +1020,12 @@ class Core:
         particular input modes the bot is configured to handle.
         It also handles low-level commands prior to passing input to Rasa NLU, such
         as toggling 'show parse' (s), changing logging level (d=DEBUG, i=INFO, 
-        w=WARN) or quiting (q)"""
+        w=WARN), showing (m) or exporting (x) stage timings, reloading retrained
+        models (r) or quiting (q)"""
         if os.path.exists(self.history_file):
             readline.read_history_file(self.history_file)
         self.prompt_text = u.STY_CURSOR + ' > ' + u.STY_USER
+        self.logger.debug('Time to first prompt: {secs:.3f}s'.format(secs=time.time() - IMPORT_START))
         try:
             while True:
                 self.user_input = input(self.prompt_text)
@@ -485,21 +1034,102 @@ class Core:
                 self.update_user_stats()
                 self.print_user_stats(self.user_stats)
                 self.check_input(self.user_input, self.show_parse)
+                self.print_metrics(self.show_metrics)
         finally:
             readline.write_history_file(self.history_file)
 
 
-@click.command()
-@click.option('--channel', default='screen', help='The input channel (screen). Default is screen.')
+@click.group(invoke_without_command=True)
+@click.option('--channel', default='screen', help='The input channel (screen / http). Default is screen.')
 @click.option('--config', default='', help='The location of the config file.')
 @click.option('--loglvl', default='', help='The level at which logging is done (DEBUG / INFO / WARN). Not case sensitive. Default level is INFO.')
-def main(channel, config, loglvl):
+@click.pass_context
+def main(ctx, channel, config, loglvl):
     """MLB: a simple multi-lingual bot that can respond to questions on academic subjects"""
+    ctx.obj = {'channel': channel, 'config': config, 'loglvl': loglvl}
+    if ctx.invoked_subcommand is not None:
+        return
+    if channel == 'http':
+        ch_out = {'screen': False}
+        c = Core(channels_out = ch_out, channel_in = channel, loglvl = loglvl, config_override = config)
+        from channel_http import HttpChannel
+        HttpChannel(c, c.http_host, c.http_port, c.http_workers).serve()
+        c.before_quit()
     ch_out = {'screen': True}
     c = Core(channels_out = ch_out, channel_in = channel, loglvl = loglvl, config_override = config)
     c.say_text('Hello!  \n\n\tI am configured to handle: ' + ', '.join([c.langs_handled[l] for l in c.lang_interpreters]))
     c.main_loop()
 
 
+@main.command()
+@click.option('--in', 'in_file', type=click.File('r', encoding='utf-8'), required=True, help='File of messages to process, one per line (- for stdin).')
+@click.option('--out', 'out_file', type=click.File('w', encoding='utf-8'), default='-', help='JSONL file to write the results to. Default is stdout.')
+@click.option('--batch-size', default=256, help='Number of messages in a language to parse together. Default is 256.')
+@click.pass_context
+def batch(ctx, in_file, out_file, batch_size):
+    """Detects the language of and parses a file of messages offline"""
+    ch_out = {'screen': False}
+    c = Core(channels_out = ch_out, loglvl = ctx.obj['loglvl'], config_override = ctx.obj['config'])
+    from batch import run_batch
+    count, errors = run_batch(c, in_file, out_file, batch_size)
+    c.logger.info('Batch complete: {count} messages processed'.format(count=count))
+    if errors > 0:
+        c.logger.warn('{errors} messages could not be parsed (see the error field of their records)'.format(errors=errors))
+    c.before_quit()
+
+
+@main.command()
+@click.option('--lang', 'langs', multiple=True, help='Only consider this language (can be given more than once). Default is every language config found.')
+@click.option('--force', is_flag=True, help='Retrain even if the config and training data are unchanged.')
+@click.option('--cpus', default=0, help='CPU cores that training may use in total. Default (0) is all of them.')
+@click.pass_context
+def train(ctx, langs, force, cpus):
+    """Trains the models for every config/mlb_config_XX.json whose config or
+    training data have changed, in parallel"""
+    logger = u.setup_custom_logger('root')
+    logger.setLevel(logging.DEBUG if ctx.obj['loglvl'].lower().strip() == 'debug' else logging.INFO)
+    from training import train_models, MANIFEST_FILE
+    results = train_models(langs, force, cpus, logger)
+    logger.info('Training complete: ' + ', '.join('{lang} {result}'.format(lang=lang, result=result) for lang, result in sorted(results.items()))
+        + ' (manifest: ' + MANIFEST_FILE + ')')
+    if 'failed' in results.values():
+        sys.exit(1)
+
+
+@main.command()
+@click.option('--lang', 'langs', multiple=True, help='Only evaluate this language (can be given more than once). Default is every language config found.')
+@click.option('--folds', default=5, help='Number of cross-validation folds. Default is 5.')
+@click.option('--processes', default=0, help='Processes to cross-validate in. Default (0) is one per language, up to the number of CPU cores.')
+@click.option('--no-cv', is_flag=True, help='Skip cross-validation and only check routing.')
+@click.option('--seed', default=0, help='Random seed for the folds, so runs can be compared. Default is 0.')
+@click.option('--out', 'out_file', type=click.File('w', encoding='utf-8'), default=None, help='JSON file to save the full results to (including every utterance).')
+@click.pass_context
+def evaluate(ctx, langs, folds, processes, no_cv, seed, out_file):
+    """Cross-validates each language's intent classifier (in parallel) and sends
+    every training utterance through the bot's routing, reporting confusion
+    matrices, misroute rates and latency per language"""
+    import json
+    from evaluation import start_cross_validation, evaluate_routing, print_results
+    # the cross-validation processes are started before the interpreters are loaded here
+    pool, pending = (None, {}) if no_cv else start_cross_validation(langs, folds, processes, seed)
+    ch_out = {'screen': False}
+    c = Core(channels_out = ch_out, loglvl = ctx.obj['loglvl'], config_override = ctx.obj['config'])
+    c.logger.info('Sending training utterances through routing')
+    results = {'routing': evaluate_routing(c, langs), 'cross_validation': {}}
+    if pool is not None:
+        c.logger.info('Waiting for cross-validation')
+        for lang, result in pending.items():
+            try:
+                results['cross_validation'][lang] = result.get()
+            except Exception as e:
+                c.logger.error('Cross-validation failed for {lang}: {e}'.format(lang=lang, e=str(e)))
+        pool.join()
+    print_results(results, sys.stdout)
+    if out_file is not None:
+        json.dump(results, out_file, indent=2, ensure_ascii=False)
+        c.logger.info('Results saved to ' + out_file.name)
+    c.before_quit()
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""A bounded cache of parse results, so repeated inputs skip language detection and parsing"""
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class ParseCache(object):
+    """Least recently used cache of parse results keyed by (lang, cleaned text)
+
+    A lookup is by cleaned text alone (the language it was last processed as is
+    remembered), so a hit skips language detection as well as parsing.
+
+    A parse can still be under way when its language is invalidated (eg its
+    model reloaded), so generation is read before parsing and passed to put,
+    which drops the result if the language has been invalidated meanwhile.
+
+    max_size: maximum number of results kept (the least recently used go first)
+    ttl: seconds a result stays valid for (0 = until evicted or invalidated)"""
+
+    def __init__(self, max_size=1000, ttl=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()    # (lang, text) -> (time stored, langs detected, parse response)
+        self.text_langs = {}            # text -> lang it was last processed as
+        # lang (None for all) -> times invalidated; replaced rather than changed, so it can be read without the lock
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, text, lang=None):
+        """Return: (lang, langs detected, parse response) for text, or None if not cached
+
+        lang: only look for a result in this language (by default the language
+            text was last processed as)"""
+        with self._lock:
+            if lang is None:
+                lang = self.text_langs.get(text)
+            entry = self.entries.get((lang, text)) if lang is not None else None
+            if entry is None:
+                self.misses += 1
+                return None
+            if (self.ttl > 0) and (entry[0] + self.ttl < time.time()):
+                self._remove((lang, text))
+                self.misses += 1
+                return None
+            self.entries.move_to_end((lang, text))
+            self.hits += 1
+            return lang, entry[1], entry[2]
+
+    def generation(self):
+        """Return: a marker of what has been invalidated so far, to pass to put"""
+        return self.generations
+
+    def put(self, lang, text, langs_det, resp, detected=True, generation=None):
+        """Caches the parse of text in lang
+
+        detected: False when lang was not detected from text (eg it was kept to
+            from the user's session), in which case the result can only be found
+            by a get for that lang, not by text alone
+        generation: what generation returned before the parse started (if lang
+            has been invalidated since, the result is not cached)"""
+        with self._lock:
+            if (generation is not None) and any(generation.get(key, 0) != self.generations.get(key, 0) for key in (lang, None)):
+                return
+            self.entries[(lang, text)] = (time.time(), langs_det, resp)
+            self.entries.move_to_end((lang, text))
+            if detected:
+                self.text_langs[text] = lang
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        del self.entries[key]
+        if self.text_langs.get(key[1]) == key[0]:
+            del self.text_langs[key[1]]
+
+    def invalidate(self, lang=None):
+        """Drops the cached results for lang (eg when its model is reloaded) or all of them"""
+        with self._lock:
+            generations = dict(self.generations)
+            generations[lang] = generations.get(lang, 0) + 1
+            self.generations = generations
+            for key in [key for key in self.entries if (lang is None) or (key[0] == lang)]:
+                self._remove(key)
+
+    def stats(self):
+        """Return: a dictionary of the cache counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': (float(self.hits) / lookups) if lookups > 0 else 0.0}
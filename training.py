@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""Training of the per-language Rasa NLU models, only retraining what changed
+
+Each config/mlb_config_XX.json (with the training data it names) is hashed and
+compared with the training manifest, so a language is only retrained when its
+config or data has changed (or its model is missing).  The languages that need
+training are trained at the same time in separate processes, as many as fit in
+the CPU budget given the num_threads each config asks for."""
+
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import logging
+import datetime
+import subprocess
+
+CONFIG_PATTERN = os.path.join('config', 'mlb_config_*.json')
+MANIFEST_FILE = os.path.join('projects', 'training_manifest.json')
+# config keys read by MLB when loading a model, which do not affect training
+RUNTIME_ONLY_KEYS = ('mlb_spacy',)
+
+
+class TrainingJob(object):
+    """One language to (possibly) train, from its config file"""
+
+    def __init__(self, config_file):
+        self.config_file = config_file
+        self.lang = os.path.splitext(os.path.basename(config_file))[0].rsplit('_', 1)[-1]
+        with open(config_file, encoding='utf-8') as config_in:
+            self.config = json.load(config_in)
+        self.data_file = self.config.get('data')
+        self.threads = max(1, int(self.config.get('num_threads') or 1))
+        self.model_dir = os.path.join(self.config.get('path') or 'projects', self.config.get('project') or 'default',
+            self.config.get('fixed_model_name') or ('current_' + self.lang))
+        self.log_file = os.path.join(os.path.dirname(self.model_dir), 'train_{lang}.log'.format(lang=self.lang))
+        self.input_hash = self.hash_inputs()
+        self.process = None
+        self.started = None
+
+    def hash_inputs(self):
+        """Return: a hash of the config and the training data it uses (leaving
+        out mlb_spacy, which only affects how the model is loaded)"""
+        sha = hashlib.sha256()
+        config = {key: value for key, value in self.config.items() if key not in RUNTIME_ONLY_KEYS}
+        sha.update(json.dumps(config, sort_keys=True).encode('utf-8') + b'\0')
+        data_file = self.data_file or ''
+        sha.update(data_file.encode('utf-8') + b'\0')
+        if os.path.isfile(data_file):
+            with open(data_file, 'rb') as data_in:
+                sha.update(data_in.read())
+        return sha.hexdigest()
+
+    def needs_training(self, manifest):
+        entry = manifest.get(self.lang)
+        return (entry is None) or (entry.get('input_hash') != self.input_hash) or (not os.path.isdir(self.model_dir))
+
+    def start(self):
+        """Starts training in a separate process (output goes to log_file)"""
+        os.makedirs(os.path.dirname(self.log_file), exist_ok=True)
+        self.log_out = open(self.log_file, 'w')
+        self.started = time.time()
+        self.process = subprocess.Popen([sys.executable, '-m', 'rasa_nlu.train', '-c', self.config_file],
+            stdout=self.log_out, stderr=subprocess.STDOUT)
+
+    def finished(self):
+        """Return: None whilst still running, otherwise the exit code"""
+        code = self.process.poll()
+        if code is not None:
+            self.log_out.close()
+        return code
+
+
+def find_jobs(langs=None):
+    """Return: a TrainingJob for every language config (or just those for langs)"""
+    jobs = [TrainingJob(config_file) for config_file in sorted(glob.glob(CONFIG_PATTERN))]
+    if langs:
+        jobs = [job for job in jobs if job.lang in langs]
+    return jobs
+
+
+def load_manifest(manifest_file=MANIFEST_FILE):
+    if os.path.exists(manifest_file):
+        with open(manifest_file, encoding='utf-8') as manifest_in:
+            return json.load(manifest_in)
+    return {}
+
+
+def save_manifest(manifest, manifest_file=MANIFEST_FILE):
+    """Writes the manifest (via a temporary file, so it is never left half written)"""
+    os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as manifest_out:
+        json.dump(manifest, manifest_out, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+
+def train_models(langs=None, force=False, cpus=0, logger=None, manifest_file=MANIFEST_FILE, poll_seconds=0.5):
+    """Trains the models whose config or training data have changed since they
+    were last trained (or all of them, if force), in parallel within a budget of
+    cpus cores (0 = all of them), recording each success in the manifest
+
+    Return: dictionary of lang -> 'trained', 'unchanged' or 'failed'"""
+    logger = logger or logging.getLogger('root')
+    cpus = cpus if cpus > 0 else (os.cpu_count() or 1)
+    manifest = load_manifest(manifest_file)
+    results = {}
+    waiting = []
+    for job in find_jobs(langs):
+        if force or job.needs_training(manifest):
+            waiting.append(job)
+        else:
+            results[job.lang] = 'unchanged'
+            logger.info('{lang}: unchanged since last trained, skipping'.format(lang=job.lang))
+
+    running = []
+    while (len(waiting) > 0) or (len(running) > 0):
+        # start as many as fit in the budget (always at least one)
+        while len(waiting) > 0:
+            in_use = sum(job.threads for job in running)
+            if (len(running) > 0) and (in_use + waiting[0].threads > cpus):
+                break
+            job = waiting.pop(0)
+            logger.info('{lang}: training with {config} (log: {log})'.format(lang=job.lang, config=job.config_file, log=job.log_file))
+            job.start()
+            running.append(job)
+
+        time.sleep(poll_seconds)
+        for job in list(running):
+            code = job.finished()
+            if code is None:
+                continue
+            running.remove(job)
+            seconds = time.time() - job.started
+            if code == 0:
+                results[job.lang] = 'trained'
+                manifest[job.lang] = {'config': job.config_file, 'data': job.data_file, 'input_hash': job.input_hash,
+                    'model_dir': job.model_dir, 'log_file': job.log_file, 'seconds': round(seconds, 1),
+                    'trained_at': datetime.datetime.now().isoformat(timespec='seconds')}
+                save_manifest(manifest, manifest_file)
+                logger.info('{lang}: trained in {secs:.1f}s'.format(lang=job.lang, secs=seconds))
+            else:
+                results[job.lang] = 'failed'
+                logger.error('{lang}: training failed after {secs:.1f}s (exit code {code}, see {log})'.format(
+                    lang=job.lang, secs=seconds, code=code, log=job.log_file))
+    return results
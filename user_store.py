@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""Persistence of the per-user stats (interaction counts etc) between runs
+
+Two stores are available:
+    sqlite: one row per user, upserted as users interact (in batches) and read
+        only when a user is first seen in a run, so a crash loses at most the
+        last few seconds of changes and start up does not depend on the number
+        of users
+    pickle: the whole user dictionary in one pickle file, read at start up and
+        written on quitting (the original behaviour)"""
+
+import os
+import sys
+import time
+import json
+import pickle
+import sqlite3
+import datetime
+import threading
+
+# user fields holding datetimes (kept as timestamps)
+TIME_FIELDS = ('last_interaction_time', 'this_interaction_time')
+
+
+class UserRecord(object):
+    """The stats etc kept for one user
+
+    A compact replacement for a dictionary per user: fields are slots, times are
+    held as timestamps, language codes are interned and buttons are a tuple
+    (shared when empty). Fields can still be read and set as user['field'], with
+    times converted to and from datetimes, and keys() allows **user."""
+
+    FIELDS = ('user_id', 'msg_output', 'lang_selected', 'last_interaction_time', 'this_interaction_time',
+        'input_counter', 'session_counter', 'total_sessions', 'current_buttons', 'rude_count', 'lang_session')
+    __slots__ = FIELDS
+
+    def __init__(self, user_id, lang_selected='en'):
+        self.user_id = user_id
+        self.msg_output = ''
+        self.lang_selected = lang_selected
+        self.last_interaction_time = None
+        self.this_interaction_time = None
+        self.input_counter = 0
+        self.session_counter = 0
+        self.total_sessions = 0
+        self.current_buttons = ()
+        self.rude_count = 0
+        self.lang_session = None    # the session (total_sessions) lang_selected was confirmed in
+
+    def keys(self):
+        return self.FIELDS
+
+    def __getitem__(self, field):
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        value = getattr(self, field)
+        if (field in TIME_FIELDS) and (value is not None):
+            return datetime.datetime.fromtimestamp(value)
+        return value
+
+    def __setitem__(self, field, value):
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        if (field in TIME_FIELDS) and isinstance(value, datetime.datetime):
+            value = value.timestamp()
+        elif field == 'lang_selected':
+            value = sys.intern(value)
+        elif field == 'current_buttons':
+            value = tuple(value)
+        setattr(self, field, value)
+
+    def __contains__(self, field):
+        return field in self.FIELDS
+
+    def idle_seconds(self, now=None):
+        """Seconds since the user last interacted (None if they never have)"""
+        if self.this_interaction_time is None:
+            return None
+        return (time.time() if now is None else now) - self.this_interaction_time
+
+    def to_dict(self):
+        """Return: the user as a dictionary (times as datetimes, as pickled by earlier versions)"""
+        record = {field: self[field] for field in self.FIELDS}
+        record['current_buttons'] = list(self.current_buttons)
+        return record
+
+    def to_json(self):
+        """Return: the user as JSON (times as timestamps)"""
+        record = {field: getattr(self, field) for field in self.FIELDS}
+        record['current_buttons'] = list(self.current_buttons)
+        return json.dumps(record)
+
+    @classmethod
+    def from_dict(cls, user_id, values):
+        """Builds a record from a dictionary of fields, eg one pickled by earlier
+        versions (times may be datetimes or timestamps and unknown fields are ignored)"""
+        record = cls(user_id)
+        for field, value in values.items():
+            if (field in cls.FIELDS) and (field != 'user_id'):
+                record[field] = value
+        return record
+
+
+def user_to_json(user):
+    return user.to_json()
+
+
+def user_from_json(user_id, text):
+    return UserRecord.from_dict(user_id, json.loads(text))
+
+
+class PickleUserStore(object):
+    """All the users in one pickle file, loaded on opening and written on closing"""
+
+    # every user is held in memory anyway, so dropping idle ones frees nothing
+    evicting_frees_memory = False
+
+    def __init__(self, pickle_file, logger):
+        self.pickle_file = pickle_file
+        self.logger = logger
+        self.users = load_pickle(pickle_file, logger)
+
+    def get(self, user_id):
+        return self.users.get(user_id)
+
+    def put(self, user_id, user):
+        self.users[user_id] = user
+
+    def flush(self):
+        try:
+            # pickled as plain dictionaries, as earlier versions did
+            users = {user_id: user.to_dict() for user_id, user in self.users.items()}
+            with open(self.pickle_file, 'wb') as pickle_out:
+                pickle.dump(users, pickle_out)
+        except Exception as e:
+            self.logger.warn('Problem pickling user dictionary')
+
+    def close(self):
+        self.flush()
+
+
+class SqliteUserStore(object):
+    """Users kept in an SQLite database (in WAL mode), one row per user
+
+    Changed users are written in one transaction once flush_every of them are
+    waiting, and every flush_seconds by a background thread."""
+
+    evicting_frees_memory = True
+
+    def __init__(self, db_file, logger, flush_every=50, flush_seconds=5.0):
+        self.db_file = db_file
+        self.logger = logger
+        self.flush_every = flush_every
+        self.pending = {}   # user_id -> user waiting to be written
+        self._lock = threading.RLock()
+
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, record TEXT NOT NULL, updated REAL NOT NULL)')
+        self.conn.commit()
+
+        self._stop = threading.Event()
+        self._flusher = None
+        if flush_seconds > 0:
+            self._flusher = threading.Thread(target=self._flush_periodically, args=(flush_seconds,), name='user-store-flush')
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def get(self, user_id):
+        with self._lock:
+            if user_id in self.pending:
+                return self.pending[user_id]
+            row = self.conn.execute('SELECT record FROM users WHERE user_id = ?', (str(user_id),)).fetchone()
+        if row is None:
+            return None
+        return user_from_json(user_id, row[0])
+
+    def put(self, user_id, user):
+        with self._lock:
+            self.pending[user_id] = user
+            if len(self.pending) >= self.flush_every:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            if len(self.pending) == 0:
+                return
+            now = time.time()
+            rows = [(str(user_id), user_to_json(user), now) for user_id, user in self.pending.items()]
+            try:
+                with self.conn:
+                    self.conn.executemany('INSERT OR REPLACE INTO users (user_id, record, updated) VALUES (?, ?, ?)', rows)
+                self.pending = {}
+            except sqlite3.Error as e:
+                self.logger.warn('Problem saving users: ' + str(e))
+
+    def _flush_periodically(self, interval):
+        while not self._stop.wait(interval):
+            self.flush()
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+        with self._lock:
+            self.conn.close()
+
+    def migrate_pickle(self, pickle_file):
+        """Imports the users from a pickle file written by the pickle store, if
+        this store is still empty (the pickle file is then renamed so it is not
+        imported again)"""
+        if (not os.path.exists(pickle_file)) or (len(self) > 0):
+            return
+        users = load_pickle(pickle_file, self.logger)
+        if len(users) == 0:
+            return
+        for user_id, user in users.items():
+            self.pending[user_id] = user
+        self.flush()
+        os.rename(pickle_file, pickle_file + '.migrated')
+        self.logger.info('Migrated {count} users from {pickle_file}'.format(count=len(users), pickle_file=pickle_file))
+
+
+def load_pickle(pickle_file, logger):
+    """Unpickles (loads) the user dictionary from pickle file so that subsequent runs still keep the same user metrics (if available)
+
+    Return: dictionary of user_id -> UserRecord"""
+    if os.path.exists(pickle_file):
+        try:
+            with open(pickle_file, 'rb') as pickle_in:
+                users = pickle.load(pickle_in)
+            return {user_id: UserRecord.from_dict(user_id, user) for user_id, user in users.items()}
+        except Exception as e:
+            logger.warn('Problem unpickling user dictionary')
+    else:
+        logger.info('No pickle file found (' + pickle_file + ') so starting with no users.')
+    return {}
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
+import re
 import logging
 from colored import fore, back, style
 
@@ -42,3 +43,59 @@ def clean_input(u_input):
     return ''.join(
         c for c in u_input if c.isalnum() or
         c in keepcharacters).rstrip()
+
+
+def rss_mb():
+    """Current resident set size of this process in MB (or None where it
+    cannot be determined, ie platforms without /proc)"""
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024.0 * 1024.0)
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def load_training_utterances(md_file):
+    """Reads the example utterances from a Rasa NLU markdown training file
+
+    Return: list of (intent, text) with entity markup ([text](entity)) and
+    comments removed"""
+    utterances = []
+    intent = None
+    with open(md_file, encoding='utf-8') as md:
+        for line in md:
+            line = line.strip()
+            if line.startswith('## intent:'):
+                intent = line[len('## intent:'):].strip()
+            elif line.startswith('##'):
+                intent = None
+            elif line.startswith('- ') and (intent is not None):
+                text = re.sub(r'<!--.*?-->', '', line[2:])
+                text = re.sub(r'\[([^\]]*)\]\([^)]*\)', r'\1', text).strip()
+                if len(text) > 0:
+                    utterances.append((intent, text))
+    return utterances
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile (pct from 0 to 100) of an already sorted list"""
+    if len(sorted_values) == 0:
+        return 0.0
+    rank = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+
+def latency_summary(samples, elapsed=None):
+    """Summarises a list of latencies (in seconds)
+
+    Return: dictionary with the count, throughput (per second, over elapsed if
+    given, otherwise the total of the samples) and p50/p95/p99/max in ms"""
+    values = sorted(samples)
+    total = elapsed if elapsed is not None else sum(values)
+    return {'count': len(values),
+        'throughput': (len(values) / total) if total > 0 else 0.0,
+        'p50_ms': percentile(values, 50) * 1000.0,
+        'p95_ms': percentile(values, 95) * 1000.0,
+        'p99_ms': percentile(values, 99) * 1000.0,
+        'max_ms': (values[-1] * 1000.0) if len(values) > 0 else 0.0}
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""A pool of parse worker processes, sharded by language
+
+Each language configured with workers gets its own pool of processes and each
+of those processes only loads the interpreter for that one language, so busy
+languages can be given more processes than rare ones without every process
+holding every spaCy model.  Parsing in separate processes means parses are not
+limited by the GIL of the main process.
+
+Worker processes are started with the spawn method rather than fork: by the
+time a pool is (re)started the main process has other threads running (eg the
+HTTP threads, interaction log writer and user store flusher), and a forked
+child can hang on a lock one of those held, eg in spaCy or BLAS."""
+
+import signal
+import multiprocessing
+
+from interpreters import InterpreterManager, parse_batch, model_version
+
+# Set in each worker process by _init_worker
+_interpreters = None
+
+
+def _init_worker(langs_handled, lang):
+    """Runs in each new worker process: loads the interpreter for its language"""
+    global _interpreters
+    # <ctrl> C is handled by the main process, which closes the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _interpreters = InterpreterManager({lang: langs_handled[lang]})
+    try:
+        _interpreters.get(lang)
+    except Exception as e:
+        # left to be retried (and reported) by the first parse
+        _interpreters.logger.error('Worker could not load interpreter for {lang}: {e}'.format(lang=lang, e=str(e)))
+
+
+def _parse(lang, text):
+    return _interpreters.parse(lang, text)
+
+
+def _parse_batch(lang, texts):
+    return parse_batch(_interpreters.get(lang), texts)
+
+
+class WorkerPool(object):
+    """Routes parses to the pool of worker processes for their language
+
+    workers_per_lang: dictionary of lang -> number of worker processes (languages
+        with no workers are not handled by the pool)"""
+
+    def __init__(self, langs_handled, workers_per_lang, logger):
+        self.langs_handled = langs_handled
+        self.logger = logger
+        self.pools = {}
+        self.worker_counts = {}
+        self.versions = {}  # lang -> model_version of the model the workers loaded
+        for lang, count in workers_per_lang.items():
+            if (lang in langs_handled) and (count > 0):
+                self.logger.info('Starting {count} parse worker(s) for {language}'.format(count=count, language=langs_handled[lang]))
+                self.versions[lang] = model_version(lang)
+                self.pools[lang] = self._start_pool(lang, count)
+                self.worker_counts[lang] = count
+
+    def _start_pool(self, lang, count):
+        return multiprocessing.get_context('spawn').Pool(processes=count,
+            initializer=_init_worker, initargs=(self.langs_handled, lang))
+
+    def __contains__(self, lang):
+        return lang in self.pools
+
+    def parse(self, lang, text):
+        """Parses text in a worker for its language (blocking until done)"""
+        pool = self.pools[lang]
+        try:
+            return pool.apply(_parse, (lang, text))
+        except ValueError:
+            # the pool was closed by restart just as this parse started
+            if self.pools[lang] is pool:
+                raise
+            return self.pools[lang].apply(_parse, (lang, text))
+
+    def restart(self, lang, force=False):
+        """Replaces the workers for lang with new ones (eg to pick up a retrained
+        model). The old workers carry on parsing until the new ones have loaded
+        the model and are then closed once their queued parses are done.
+
+        force: restart even if the model has not changed
+
+        Return: True if new workers were swapped in"""
+        version = model_version(lang)
+        if (not force) and (self.versions.get(lang) == version):
+            return False
+        new_pool = self._start_pool(lang, self.worker_counts[lang])
+        try:
+            # check the new model loads and parses before it takes any real input
+            new_pool.apply(_parse, (lang, 'hello'))
+        except Exception:
+            new_pool.terminate()
+            raise
+        old_pool = self.pools[lang]
+        self.pools[lang] = new_pool
+        self.versions[lang] = version
+        old_pool.close()
+        old_pool.join()
+        self.logger.info('Restarted parse worker(s) for {language}'.format(language=self.langs_handled[lang]))
+        return True
+
+    def parse_batch(self, lang, texts):
+        """Parses a list of texts, split across all the workers for their language"""
+        pool = self.pools[lang]
+        chunk_size = max(1, -(-len(texts) // self.worker_counts[lang]))
+        chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+        results = []
+        for chunk_results in pool.starmap(_parse_batch, [(lang, chunk) for chunk in chunks]):
+            results.extend(chunk_results)
+        return results
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.terminate()
+            pool.join()
+        self.pools = {}